@@ -1,14 +1,12 @@
-import json
-import gzip
 import sys
-from utils import tqdm_joblib
-from tqdm import tqdm
 import os
 import argparse
 import utils
-import operator
-from joblib import Parallel, delayed
-from typing import List, Dict, Set, Tuple, Any
+import sharding
+import trec_io
+import itertools
+import numpy as np
+from typing import List, Dict, Set, Tuple, Any, Iterable, Iterator, Union
 from object_models import Location, Entity, AnnotatedText, AspectLinkExample, Aspect, Context
 
 totals = {
@@ -20,69 +18,133 @@ totals = {
     'validation.jsonl.gz': 4313,
     'nanni-201.modified.jsonl.gz': 143
 }
-
-
-def rank_aspects(data_file: str, entity_ranking: Dict[str, Dict[str, float]], k: int) -> Dict[str, Dict[str, float]]:
-    total = totals[os.path.basename(data_file)]
+SCORING = ('count', 'score')
+
+
+def rank_examples(
+        examples: Iterable[AspectLinkExample],
+        entity_ranking: Union[trec_io.Run, Dict[str, Dict[str, float]]],
+        k: int,
+        scoring: str = 'count'
+) -> Dict[str, Dict[str, float]]:
+    pairs = ((example, entity_ranking[example.id]) for example in examples if example.id in entity_ranking)
+    return rank_pairs(pairs, k, scoring)
+
+
+def rank_pairs(
+        pairs: Iterable[Tuple[AspectLinkExample, Dict[str, float]]],
+        k: int,
+        scoring: str = 'count'
+) -> Dict[str, Dict[str, float]]:
+    """
+    Ranks the candidate aspects of every (example, entity ranking of the example) pair.
+    """
     ranking: Dict[str, Dict[str, float]] = {}
-    for example in tqdm(utils.aspect_link_examples(data_file), total=total):
-        query_id = example.id
-        if query_id in entity_ranking:
-            documents: List[Aspect] = example.candidate_aspects
-            entities = entity_ranking[query_id]
-            entities = dict(list(entities.items())[:k])
-            rank_docs(query_id, documents, entities, ranking)
+    for example, entities in pairs:
+        documents: List[Aspect] = example.candidate_aspects
+        if len(entities) > k:
+            entities = dict(itertools.islice(entities.items(), k))
+        rank_docs(example.id, documents, entities, ranking, scoring)
 
     return ranking
 
 
-def write_to_file(ranking: Dict[str, Dict[str, float]], save: str):
-    with open(save, 'w') as f:
-        for query_id, scores in ranking.items():
-            sorted_scores = dict(sorted(scores.items(), key=operator.itemgetter(1), reverse=True))
-            rank = 1
-            for doc_id, score in sorted_scores.items():
-                f.write(query_id + ' Q0 ' + doc_id + ' ' + str(rank) + ' ' + str(score) + ' EntityRanking\n')
-                rank += 1
+def run_groups(
+        entity_run_file: str,
+        k: int = None,
+        presorted: bool = False,
+        tmp_dir: str = None
+) -> Iterator[Tuple[str, Dict[str, float]]]:
+    """
+    Streams the entity ranking of every query of a run file, in ascending order of query id.
+    Unless `presorted`, the run file is first sorted by query id (see `utils.external_sort`); the sort is stable,
+    so the entities of a query stay in rank order. With `k`, only the first k entities of every query are kept.
+    """
+    with open(entity_run_file, 'r') as f:
+        lines = (line for line in f if line.strip())
+        if not presorted:
+            lines = utils.external_sort(lines, key=lambda line: line.split(None, 1)[0], tmp_dir=tmp_dir)
+        yield from trec_io.read_run_groups(lines, k)
 
 
-def load_run(entity_run_file: str) -> Dict[str, Dict[str, float]]:
-    ranking: Dict[str, Dict[str, float]] = {}
-    with open(entity_run_file, 'r') as f:
-        for line in f:
-            line_parts = line.split()
-            query_id = line_parts[0]
-            doc_id = line_parts[2]
-            doc_score = float(line_parts[4])
-            scores: Dict[str, float] = ranking[query_id] if query_id in ranking else {}
-            scores[doc_id] = doc_score
-            ranking[query_id] = scores
+class RunJoin:
+    """
+    Merge-join of examples with the query groups of a run file (see `run_groups`), both in ascending order of query
+    id. `join` is called with consecutive batches of examples and keeps its position in the run file in between,
+    so only the current query group is held in memory.
+    """
+
+    def __init__(self, groups: Iterator[Tuple[str, Dict[str, float]]]):
+        self.groups = iter(groups)
+        self.group: Tuple[str, Dict[str, float]] = next(self.groups, None)
+        self.last_id: str = None
+
+    def join(self, examples: Iterable[AspectLinkExample]) -> Iterator[Tuple[AspectLinkExample, Dict[str, float]]]:
+        for example in examples:
+            if self.last_id is not None and example.id < self.last_id:
+                raise ValueError('Examples are not sorted by query id.')
+            self.last_id = example.id
+            while self.group is not None and self.group[0] < example.id:
+                self.group = next(self.groups, None)
+            if self.group is not None and self.group[0] == example.id:
+                yield example, self.group[1]
 
-    return ranking
+
+def make_run_file_strings(ranking: Dict[str, Dict[str, float]]) -> Iterator[str]:
+    for query_id, scores in ranking.items():
+        yield from trec_io.run_lines(query_id, utils.top_k_items(scores), 'EntityRanking')
+
+
+def load_run(entity_run_file: str, k: int = None) -> trec_io.Run:
+    """
+    Loads a run file (text or binary, see `trec_io.py`). With `k`, only the first k entities of every query
+    (in file order) are kept.
+    """
+    return trec_io.read_run(entity_run_file, k)
 
 
 def rank_docs(
         query_id: str,
         candidate_aspects: List[Aspect],
         entity_ranking: Dict[str, float],
-        ranking: Dict[str, Dict[str, float]]
+        ranking: Dict[str, Dict[str, float]],
+        scoring: str = 'count'
 ) -> None:
+    """
+    Scores the candidate aspects of a query.
+    :param scoring: `count`: number of top-k entities in the aspect; `score`: sum of their entity scores.
+    """
+    if scoring not in SCORING:
+        raise ValueError('Scoring must be `count` or `score`.')
+    aspect_entities: List[List[str]] = [
+        utils.get_entity_ids_only(aspect.aspect_content.entities) for aspect in candidate_aspects
+    ]
+    aspect_scores: List[float] = score_aspects(aspect_entities, entity_ranking)[:, SCORING.index(scoring)].tolist()
     aspect_ranking: Dict[str, float] = {}
-    for aspect in candidate_aspects:
-        aspect_id: str = aspect.aspect_id
-        aspect_entities: List[str] = utils.get_entity_ids_only(aspect.aspect_content.entities)
-        aspect_score: float = score_aspect(aspect_entities, entity_ranking)
-        aspect_ranking[aspect_id] = aspect_score
+    for aspect, aspect_score in zip(candidate_aspects, aspect_scores):
+        aspect_ranking[aspect.aspect_id] = aspect_score
     ranking[query_id] = aspect_ranking
 
 
-def score_aspect(aspect_entities: List[str], entity_scores: Dict[str, float]) -> float:
+def score_aspects(aspect_entities: List[List[str]], entity_scores: Dict[str, float]) -> np.ndarray:
+    """
+    Scores all candidate aspects of a query in one pass.
+    The top-k entities are interned to columns 0..k-1 and every aspect becomes a row of a membership bitmap
+    (an entity mentioned twice in an aspect sets its bit once, so it is counted once). One product of the bitmap with
+    the (1, entity score) columns gives both the overlap count and the weighted overlap of every aspect.
+    :return: Matrix of shape (num_aspects, 2): the count and the sum of entity scores of every aspect (see `SCORING`).
+    """
+    columns: Dict[str, int] = {entity_id: column for column, entity_id in enumerate(entity_scores)}
+    mentions = np.fromiter((columns.get(entity_id, -1) for entities in aspect_entities for entity_id in entities),
+                           dtype=np.int64)
+    owners = np.repeat(np.arange(len(aspect_entities)), [len(entities) for entities in aspect_entities])
+    known = mentions >= 0
 
-    c = 0
-    for entity_id in entity_scores.keys():
-        if entity_id in aspect_entities:
-            c += 1
-    return float(c)
+    bitmap = np.zeros((len(aspect_entities), len(columns)), dtype=np.float64)
+    bitmap[owners[known], mentions[known]] = 1.0
+    weights = np.ones((len(columns), 2), dtype=np.float64)
+    weights[:, 1] = np.fromiter(entity_scores.values(), dtype=np.float64, count=len(columns))
+    return bitmap @ weights
 
 
 def main():
@@ -91,19 +153,47 @@ def main():
     parser.add_argument("--entity-run", help="Entity run file.", required=True, type=str)
     parser.add_argument("--save", help="Output directory.", required=True, type=str)
     parser.add_argument("--k", help="Top-K entities to consider.", type=int, default=100)
+    parser.add_argument("--scoring", help="Aspect score: number of top-K entities in the aspect, or the sum of their "
+                                          "scores (count|score). Default: count.", default='count', choices=SCORING)
+    parser.add_argument("--stream", help="Merge-join the run file with the data file in query id order instead of "
+                                         "loading the run file; memory does not grow with the number of queries. "
+                                         "The output is in query id order.", action='store_true')
+    parser.add_argument("--presorted", help="stream: The run file and the data file are already sorted by query id "
+                                            "(e.g., with LC_ALL=C sort -s -k1,1), so the external sort is skipped.",
+                        action='store_true')
+    parser.add_argument("--tmp-dir", help="stream: Directory for the external sort. Default: system temp directory.",
+                        default=None, type=str)
+    sharding.add_arguments(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
-
-    print('Loading entity run file...')
-    entity_ranking: Dict[str, Dict[str, float]] = load_run(args.entity_run)
-    print('[Done].')
+    fields: Set[str] = {'id', 'aspects'}
+
+    if args.stream:
+        join = RunJoin(run_groups(args.entity_run, args.k, args.presorted, args.tmp_dir))
+        if args.presorted:
+            read_examples = lambda select: utils.aspect_link_examples(args.data, fields=fields, select=select)
+        else:
+            read_examples = lambda select: utils.sorted_aspect_link_examples(
+                args.data, fields=fields, select=select, tmp_dir=args.tmp_dir)
+        rank_chunk = lambda examples: rank_pairs(join.join(examples), args.k, args.scoring)
+    else:
+        print('Loading entity run file...')
+        entity_ranking: trec_io.Run = load_run(args.entity_run, args.k)
+        print('[Done].')
+        read_examples = lambda select: utils.aspect_link_examples(args.data, fields=fields, select=select)
+        rank_chunk = lambda examples: rank_examples(examples, entity_ranking, args.k, args.scoring)
 
     print('Ranking aspects..')
-    ranking: Dict[str, Dict[str, float]] = rank_aspects(args.data, entity_ranking, args.k)
-    print('[Done].')
-
-    print('Writing to run file...')
-    write_to_file(ranking, args.save)
+    output_file: str = sharding.run(
+        read_examples=read_examples,
+        process_chunk=lambda examples: make_run_file_strings(rank_chunk(examples)),
+        save=args.save,
+        shard=args.shard,
+        checkpoint_every=args.checkpoint_every,
+        resume=args.resume,
+        total=totals.get(os.path.basename(args.data))
+    )
     print('[Done].')
+    print('Run file written to ==> {}'.format(output_file))
 
 
 if __name__ == '__main__':
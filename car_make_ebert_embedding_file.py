@@ -1,11 +1,14 @@
 from wikipedia2vec import Wikipedia2Vec, Dictionary
 import os
+from collections import OrderedDict
 import numpy as np
-from typing import Dict, List
+from typing import Dict, List, Tuple, Optional
 import argparse
 import sys
-import json
 import tqdm
+import entity_resolution
+import embedding_writer
+from embedding_writer import convert_rows
 
 
 class LinearMapper:
@@ -45,16 +48,17 @@ class Embedding:
 
 
 class Wikipedia2VecEmbedding(Embedding):
-    def __init__(self, path, prefix="ENTITY/", do_cache_dict=True, do_lower_case=False):
-        from wikipedia2vec import Wikipedia2Vec, Dictionary
+    def __init__(self, path, prefix="ENTITY/", do_cache_dict=True, do_lower_case=False, cache_size=1000000):
         if os.path.exists(path):
             self.model = Wikipedia2Vec.load(path)
         else:
             raise FileNotFoundError()
 
+        # Bounded (LRU) cache of dictionary lookups, keyed by the word as given: a hit skips the preprocessing too.
         self.dict_cache = None
+        self.cache_size = cache_size
         if do_cache_dict:
-            self.dict_cache = {}
+            self.dict_cache = OrderedDict()
 
         self.prefix = prefix
         self.do_lower_case = do_lower_case
@@ -67,18 +71,20 @@ class Wikipedia2VecEmbedding(Embedding):
         return word
 
     def index(self, word):
-        preprocessed_word = self._preprocess_word(word)
-
-        if self.dict_cache is not None and preprocessed_word in self.dict_cache:
-            return self.dict_cache[preprocessed_word]
+        if self.dict_cache is not None and word in self.dict_cache:
+            self.dict_cache.move_to_end(word)
+            return self.dict_cache[word]
 
+        preprocessed_word = self._preprocess_word(word)
         if word.startswith(self.prefix):
             ret = self.model.dictionary.get_entity(preprocessed_word)
         else:
             ret = self.model.dictionary.get_word(preprocessed_word)
 
         if self.dict_cache is not None:
-            self.dict_cache[preprocessed_word] = ret
+            self.dict_cache[word] = ret
+            if len(self.dict_cache) > self.cache_size:
+                self.dict_cache.popitem(last=False)
 
         return ret
 
@@ -93,6 +99,13 @@ class Wikipedia2VecEmbedding(Embedding):
     def get_vectors(self, words):
         return np.stack([self.get_vector(word) for word in words], 0)
 
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        The whole (word and entity) embedding matrix; row `index(word).index` is the vector of `word`.
+        """
+        return self.model.syn0
+
     @property
     def all_special_tokens(self):
         return []
@@ -118,18 +131,58 @@ class EBertEmbedding(Embedding):
         return self.embedding.all_special_tokens
 
 
-def convert(ebert: EBertEmbedding, id2name: Dict[str, str]):
-    id2vec = {}
-    unknown = []
-
-    for entity_id, entity_name in tqdm.tqdm(id2name.items(), total=len(id2name)):
-        wiki2vec_entity = to_wiki2vec_entity(entity_name.strip())
-        if in_vocab(wiki2vec_entity, ebert):
-            embedding = [float(x) for x in ebert[wiki2vec_entity]]
-            id2vec[entity_id] = embedding
+def resolve_rows(
+        ebert: EBertEmbedding,
+        id2name: Dict[str, str]
+) -> Tuple[List[str], np.ndarray, List[str]]:
+    """
+    Looks up every CAR entity once in the Wikipedia2Vec dictionary.
+    :return: (entity ids in the vocabulary, their rows in the Wikipedia2Vec matrix, unknown entity ids)
+    """
+    known: List[str] = []
+    rows: List[int] = []
+    unknown: List[str] = []
+    for entity_id, entity_name in tqdm.tqdm(id2name.items(), total=len(id2name), desc='Resolving entities'):
+        item = ebert.index(to_wiki2vec_entity(entity_name.strip()))
+        if item is not None:
+            known.append(entity_id)
+            rows.append(item.index)
         else:
             unknown.append(entity_id)
+    return known, np.asarray(rows, dtype=np.int64), unknown
+
 
+def mapped_chunks(ebert: EBertEmbedding, rows: np.ndarray, chunk_size: int = 65536):
+    """
+    E-BERT vectors of the given Wikipedia2Vec rows, `chunk_size` rows at a time: the raw vectors of a chunk are
+    gathered into one array and mapped with a single matrix product.
+    Yields (start, matrix of shape (chunk, dim)).
+    """
+    vectors: np.ndarray = ebert.embedding.vectors
+    for start in tqdm.tqdm(range(0, len(rows), chunk_size), desc='Mapping'):
+        yield start, ebert.mapper.apply(vectors[rows[start:start + chunk_size]])
+
+
+def convert_batch(
+        ebert: EBertEmbedding,
+        id2name: Dict[str, str],
+        out_file: Optional[str] = None,
+        chunk_size: int = 65536,
+        resolution: Optional[entity_resolution.Resolution] = None,
+        fmt: str = 'npy',
+        resume: bool = False
+):
+    """
+    Maps the CAR entities to their vectors, `chunk_size` entities at a time.
+    With `out_file`, the vectors are streamed to it in format `fmt` (see `embedding_writer.py`), and the returned
+    id2vec is None. Otherwise, id2vec is a {entity_id: vector} dict.
+    :param resolution: Result of `resolve_rows`, e.g., from `entity_resolution.cached_resolution`.
+    :param resume: Continue an interrupted conversion to `out_file` after its last committed chunk.
+    :return: (id2vec, unknown)
+    """
+    known, rows, unknown = resolution if resolution is not None else resolve_rows(ebert, id2name)
+    id2vec = convert_rows(lambda selected: mapped_chunks(ebert, selected, chunk_size), known, rows,
+                          ebert.mapper.model.shape[1], out_file, fmt, resume)
     return id2vec, unknown
 
 
@@ -139,10 +192,6 @@ def load_embeddings(wiki2vec_file: str, mapping_file: str) -> EBertEmbedding:
     return EBertEmbedding(embedding=w2v, mapper=mapper)
 
 
-def in_vocab(entity: str, model: EBertEmbedding) -> bool:
-    return True if entity in model else False
-
-
 def to_wiki2vec_entity(entity: str) -> str:
     return 'ENTITY/' + entity.replace(' ', '_')
 
@@ -167,7 +216,9 @@ def main():
     parser.add_argument("--mapper", help="Mapping file for E-BERT (.npy file).", required=True)
     parser.add_argument("--id2name", help="Mappings from CAR EntityId to EntityName.", required=True)
     parser.add_argument("--save", help="Output directory.", required=True)
+    embedding_writer.add_arguments(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    embedding_writer.check_arguments(parser, args)
 
     print('Loading entity embeddings...')
     ebert: EBertEmbedding = load_embeddings(wiki2vec_file=args.wiki2vec, mapping_file=args.mapper)
@@ -177,22 +228,21 @@ def main():
     id2name: Dict[str, str] = read_tsv(args.id2name)
     print('[Done].')
 
-    print('Mapping CAR entities to E-BERT embeddings..')
-    id2vec, unknown = convert(ebert=ebert, id2name=id2name)
-    print('[Done].')
-
-    out_file = os.path.join(args.save, 'car_entity_to_ebert_vec.json')
-    stats_file = os.path.join(args.save, 'unknown_car_entities.txt')
+    out_file = os.path.join(args.save, 'car_entity_to_ebert_vec.' + args.format)
 
-    print('Writing to file..')
-    with open(out_file, 'w') as f:
-        json.dump(id2vec, f)
+    print('Resolving CAR entities...')
+    resolution = entity_resolution.cached_resolution(embedding_writer.resolution_cache(args), args.wiki2vec,
+                                                     args.id2name, lambda: resolve_rows(ebert, id2name))
+    print('[Done].')
 
-    with open(stats_file, 'w') as f:
-        f.write("%s\n" % len(unknown))
-        for item in unknown:
-            f.write("%s\n" % item)
+    print('Mapping CAR entities to E-BERT embeddings..')
+    # The output is written while mapping.
+    _, unknown = convert_batch(ebert=ebert, id2name=id2name, out_file=out_file, chunk_size=args.chunk_size,
+                               resolution=resolution, fmt=args.format, resume=args.resume)
     print('[Done].')
+    print('Embeddings written to ==> {}'.format(out_file))
+
+    embedding_writer.finish(out_file, unknown, args)
 
 
 if __name__ == '__main__':
@@ -1,32 +1,73 @@
 import os
 import numpy as np
-from typing import Dict, List
+from typing import Dict, List, Tuple, Optional
 import argparse
 import sys
-import json
 import tqdm
+import entity_resolution
+import embedding_writer
+from embedding_writer import convert_rows
 import gensim
 
 
-def convert(wiki2vec: gensim.models.KeyedVectors, id2name: Dict[str, str]):
-
-    id2vec = {}
-    unknown = []
+def vocabulary_index(model) -> Dict[str, int]:
+    """
+    Row of every key of the model (gensim >= 4: `key_to_index`; gensim 3: `vocab[key].index`).
+    """
+    if hasattr(model, 'key_to_index'):
+        return model.key_to_index
+    return {key: vocab.index for key, vocab in model.vocab.items()}
 
-    for entity_id, entity_name in tqdm.tqdm(id2name.items(), total=len(id2name)):
-        wiki2vec_entity = to_wiki2vec_entity(entity_name.strip())
-        if in_vocab(wiki2vec_entity, wiki2vec):
-            embedding = [float(x) for x in wiki2vec[wiki2vec_entity]]
-            id2vec[entity_id] = embedding
-        else:
-            unknown.append(entity_id)
 
-    return id2vec, unknown
+def resolve_rows(model, id2name: Dict[str, str]) -> Tuple[List[str], np.ndarray, List[str]]:
+    """
+    Resolves all CAR entity names to rows of the model in one pass over the vocabulary index.
+    :return: (entity ids in the vocabulary, their rows, unknown entity ids)
+    """
+    index: Dict[str, int] = vocabulary_index(model)
+    entity_ids: List[str] = list(id2name.keys())
+    rows = np.fromiter((index.get(to_wiki2vec_entity(name.strip()), -1) for name in id2name.values()),
+                       dtype=np.int64, count=len(id2name))
+    known = rows >= 0
+    return ([entity_id for entity_id, k in zip(entity_ids, known.tolist()) if k], rows[known],
+            [entity_id for entity_id, k in zip(entity_ids, known.tolist()) if not k])
 
 
-def in_vocab(entity: str, model) -> bool:
-    # return True if entity in model.key_to_index.keys() else False
-    return True if entity in model.vocab else False
+def selected_chunks(vectors: np.ndarray, rows: np.ndarray, chunk_size: int = 65536):
+    """
+    Float32 vectors of the given rows, `chunk_size` at a time, in the order of `rows`.
+    Within a chunk, rows are read in ascending order, so a memory-mapped matrix is read front to back.
+    Yields (start, matrix of shape (chunk, dim)).
+    """
+    for start in tqdm.tqdm(range(0, len(rows), chunk_size), desc='Copying vectors'):
+        chunk_rows = rows[start:start + chunk_size]
+        order = np.argsort(chunk_rows, kind='stable')
+        chunk = np.empty((len(chunk_rows), vectors.shape[1]), dtype=np.float32)
+        chunk[order] = vectors[chunk_rows[order]]
+        yield start, chunk
+
+
+def convert_batch(
+        wiki2vec: gensim.models.KeyedVectors,
+        id2name: Dict[str, str],
+        out_file: Optional[str] = None,
+        chunk_size: int = 65536,
+        resolution: Optional[entity_resolution.Resolution] = None,
+        fmt: str = 'npy',
+        resume: bool = False
+):
+    """
+    Maps the CAR entities to their vectors, `chunk_size` entities at a time.
+    With `out_file`, the vectors are streamed to it in format `fmt` (see `embedding_writer.py`), and the returned
+    id2vec is None. Otherwise, id2vec is a {entity_id: vector} dict.
+    :param resolution: Result of `resolve_rows`, e.g., from `entity_resolution.cached_resolution`.
+    :param resume: Continue an interrupted conversion to `out_file` after its last committed chunk.
+    :return: (id2vec, unknown)
+    """
+    known, rows, unknown = resolution if resolution is not None else resolve_rows(wiki2vec, id2name)
+    id2vec = convert_rows(lambda selected: selected_chunks(wiki2vec.vectors, selected, chunk_size), known, rows,
+                          wiki2vec.vectors.shape[1], out_file, fmt, resume)
+    return id2vec, unknown
 
 
 def to_wiki2vec_entity(entity: str) -> str:
@@ -50,32 +91,34 @@ def main():
     parser.add_argument("--wiki2vec", help="Wiki2Vec file.", required=True)
     parser.add_argument("--id2name", help="File containing mappings from CAR EntityId to EntityName.", required=True)
     parser.add_argument("--save", help="Output directory.", required=True)
+    embedding_writer.add_arguments(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    embedding_writer.check_arguments(parser, args)
 
     print('Loading entity embeddings...')
-    wiki2vec: gensim.models.KeyedVectors = gensim.models.KeyedVectors.load(args.wiki2vec)
+    # Memory-mapped: only the pages of the selected rows are read.
+    wiki2vec: gensim.models.KeyedVectors = gensim.models.KeyedVectors.load(args.wiki2vec, mmap='r')
     print('[Done].')
 
     print('Loading entity id to name mappings...')
     id2name: Dict[str, str] = read_tsv(args.id2name)
     print('[Done].')
 
-    print('Mapping CAR entities to Wikipedia2Vec embeddings..')
-    id2vec, unknown = convert(wiki2vec=wiki2vec, id2name=id2name)
-    print('[Done].')
-
-    out_file = os.path.join(args.save, 'car_entity_to_wiki2vec_vec.json')
-    stats_file = os.path.join(args.save, 'unknown_car_entities.txt')
+    out_file = os.path.join(args.save, 'car_entity_to_wiki2vec_vec.' + args.format)
 
-    print('Writing to file..')
-    with open(out_file, 'w') as f:
-        json.dump(id2vec, f)
+    print('Resolving CAR entities...')
+    resolution = entity_resolution.cached_resolution(embedding_writer.resolution_cache(args), args.wiki2vec,
+                                                     args.id2name, lambda: resolve_rows(wiki2vec, id2name))
+    print('[Done].')
 
-    with open(stats_file, 'w') as f:
-        f.write("%s\n" % len(unknown))
-        for item in unknown:
-            f.write("%s\n" % item)
+    print('Mapping CAR entities to Wikipedia2Vec embeddings..')
+    # The output is written while mapping.
+    _, unknown = convert_batch(wiki2vec=wiki2vec, id2name=id2name, out_file=out_file, chunk_size=args.chunk_size,
+                               resolution=resolution, fmt=args.format, resume=args.resume)
     print('[Done].')
+    print('Embeddings written to ==> {}'.format(out_file))
+
+    embedding_writer.finish(out_file, unknown, args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+"""
+Crash-safe writes of multi-file outputs.
+
+Checkpoint files for resumable jobs: a small JSON document next to the output, replaced atomically.
+
+Saved artifacts made of several files (embedding indexes, binary runs, description tables, ...) are recognized by a
+JSON metadata file, written last with `written_last`: an interrupted write leaves no metadata, so a half-written
+artifact is never loaded.
+"""
+
+import os
+import json
+import contextlib
+from typing import Optional
+
+
+def checkpoint_file(output_file: str) -> str:
+    return output_file + '.checkpoint'
+
+
+def write_json(path: str, document: dict) -> None:
+    """
+    Writes a JSON file atomically: readers see either the previous file or the complete new one.
+    """
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(document, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+def read_checkpoint(output_file: str) -> Optional[dict]:
+    if not os.path.exists(checkpoint_file(output_file)):
+        return None
+    with open(checkpoint_file(output_file), 'r') as f:
+        return json.load(f)
+
+
+def write_checkpoint(output_file: str, checkpoint: dict) -> None:
+    write_json(checkpoint_file(output_file), checkpoint)
+
+
+def truncate_uncommitted(output_file: str, checkpoint: dict) -> None:
+    """
+    Truncates an append-only output file to the size recorded in its checkpoint, dropping what was written after the
+    last commit. A new checkpoint has size 0, so a run that starts over gets an empty file.
+    """
+    with open(output_file, 'ab') as f:
+        f.truncate(checkpoint['size'])
+
+
+@contextlib.contextmanager
+def written_last(meta_file: str, meta: dict):
+    """
+    Writes `meta` to `meta_file` once the `with` block (which writes the data files) has finished without error.
+    The metadata of an earlier artifact at the same path is removed first, so it never describes new, partly written
+    data files.
+    """
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    yield
+    write_json(meta_file, meta)
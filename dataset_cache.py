@@ -0,0 +1,269 @@
+"""
+Pre-parsed, columnar cache of an AspectLinkExample data file (JSON-L in gzip format).
+
+A cache is a directory next to the data file (`<data_file>.cache`) holding:
+    - meta.json: Size and modification time of the source file, number of examples and aspects.
+    - String columns (<name>.bin + <name>.offsets.npy): UTF-8 blob and int64 offsets.
+        example_id, unhashed_id, true_aspect, target_entity, sentence, paragraph: one entry per example.
+        aspect_id, aspect_name: one entry per candidate aspect.
+        entities: the pool of interned entity ids.
+    - List columns (<name>.npy + <name>.offsets.npy): int32 values and int64 offsets (CSR layout).
+        sentence_entities, paragraph_entities: interned entity ids of the context, one list per example.
+        aspect_entities: interned entity ids of the aspect content, one list per candidate aspect.
+    - example_aspects.npy: int64 offsets into the aspect columns, one range per example.
+All arrays are memory-mapped when the cache is opened.
+"""
+
+import os
+import sys
+import json
+import gzip
+import argparse
+import numpy as np
+from array import array
+from tqdm import tqdm
+from typing import List, Dict, Iterator, Optional, Any
+from object_models import EntityRecord, AnnotatedTextRecord, ContextRecord, AspectRecord, AspectLinkRecord
+
+CACHE_VERSION = 1
+STRING_COLUMNS = ['example_id', 'unhashed_id', 'true_aspect', 'target_entity', 'sentence', 'paragraph',
+                  'aspect_id', 'aspect_name', 'entities']
+LIST_COLUMNS = ['sentence_entities', 'paragraph_entities', 'aspect_entities']
+# Fields (see `utils.EXAMPLE_FIELDS`) that can be served from the cache.
+CACHED_FIELDS = frozenset(['id', 'unhashed_id', 'true_aspect', 'target_entity', 'sentence', 'paragraph', 'aspects'])
+
+
+def cache_dir_for(data_file: str) -> str:
+    return data_file + '.cache'
+
+
+def source_signature(data_file: str) -> Dict[str, Any]:
+    stat = os.stat(data_file)
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def has_valid_cache(data_file: str) -> bool:
+    """
+    True if a cache exists for `data_file` and was built from the current version of the file.
+    """
+    meta_file = os.path.join(cache_dir_for(data_file), 'meta.json')
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    return meta.get('version') == CACHE_VERSION and meta.get('source') == source_signature(data_file)
+
+
+class _StringColumnWriter:
+    def __init__(self, path: str):
+        self._file = open(path + '.bin', 'wb')
+        self._path = path
+        self._offsets = array('q', [0])
+
+    def append(self, value: Optional[str]) -> None:
+        data = (value or '').encode('UTF-8')
+        self._file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+
+    def close(self) -> None:
+        self._file.close()
+        np.save(self._path + '.offsets.npy', np.frombuffer(self._offsets, dtype=np.int64))
+
+
+class _ListColumnWriter:
+    def __init__(self, path: str):
+        self._path = path
+        self._values = array('i')
+        self._offsets = array('q', [0])
+
+    def append(self, values: List[int]) -> None:
+        self._values.extend(values)
+        self._offsets.append(len(self._values))
+
+    def close(self) -> None:
+        np.save(self._path + '.npy', np.frombuffer(self._values, dtype=np.int32))
+        np.save(self._path + '.offsets.npy', np.frombuffer(self._offsets, dtype=np.int64))
+
+
+class _StringColumn:
+    def __init__(self, path: str):
+        self._offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+        size = os.path.getsize(path + '.bin')
+        self._data = np.memmap(path + '.bin', dtype=np.uint8, mode='r') if size > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self._data[self._offsets[i]:self._offsets[i + 1]].tobytes().decode('UTF-8')
+
+
+class _ListColumn:
+    def __init__(self, path: str):
+        self.values = np.load(path + '.npy', mmap_mode='r')
+        self.offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+
+def _entity_ids(annotated_text: Optional[Dict[str, Any]]) -> List[str]:
+    if not annotated_text:
+        return []
+    return [entity.get('entity_id') for entity in annotated_text.get('entities') or []]
+
+
+def build_cache(data_file: str, cache_dir: Optional[str] = None) -> str:
+    """
+    Parse `data_file` once and write its columnar cache.
+    :return: The cache directory.
+    """
+    cache_dir = cache_dir if cache_dir is not None else cache_dir_for(data_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    strings = {name: _StringColumnWriter(os.path.join(cache_dir, name)) for name in STRING_COLUMNS}
+    lists = {name: _ListColumnWriter(os.path.join(cache_dir, name)) for name in LIST_COLUMNS}
+    example_aspects = array('q', [0])
+    entity_to_int: Dict[str, int] = {}
+
+    def intern(entity_ids: List[str]) -> List[int]:
+        res: List[int] = []
+        for entity_id in entity_ids:
+            if entity_id not in entity_to_int:
+                entity_to_int[entity_id] = len(entity_to_int)
+                strings['entities'].append(entity_id)
+            res.append(entity_to_int[entity_id])
+        return res
+
+    num_examples = 0
+    with gzip.open(data_file, 'rt', encoding='UTF-8') as zipfile:
+        for line in tqdm(zipfile, desc='Building cache'):
+            example: Dict[str, Any] = json.loads(line)
+            context: Dict[str, Any] = example.get('context') or {}
+            sentence: Dict[str, Any] = context.get('sentence') or {}
+            paragraph: Dict[str, Any] = context.get('paragraph') or {}
+
+            strings['example_id'].append(example.get('id'))
+            strings['unhashed_id'].append(example.get('unhashed_id'))
+            strings['true_aspect'].append(example.get('true_aspect'))
+            strings['target_entity'].append(context.get('target_entity'))
+            strings['sentence'].append(sentence.get('content'))
+            strings['paragraph'].append(paragraph.get('content'))
+            lists['sentence_entities'].append(intern(_entity_ids(sentence)))
+            lists['paragraph_entities'].append(intern(_entity_ids(paragraph)))
+
+            candidate_aspects: List[Dict[str, Any]] = example.get('candidate_aspects') or []
+            for aspect in candidate_aspects:
+                strings['aspect_id'].append(aspect.get('aspect_id'))
+                strings['aspect_name'].append(aspect.get('aspect_name'))
+                lists['aspect_entities'].append(intern(_entity_ids(aspect.get('aspect_content'))))
+            example_aspects.append(example_aspects[-1] + len(candidate_aspects))
+            num_examples += 1
+
+    for writer in list(strings.values()) + list(lists.values()):
+        writer.close()
+    np.save(os.path.join(cache_dir, 'example_aspects.npy'), np.frombuffer(example_aspects, dtype=np.int64))
+
+    # meta.json is written last: a cache without it is incomplete and is never used.
+    with open(meta_file, 'w') as f:
+        json.dump({
+            'version': CACHE_VERSION,
+            'source': source_signature(data_file),
+            'num_examples': num_examples,
+            'num_aspects': example_aspects[-1],
+            'num_entities': len(entity_to_int),
+        }, f)
+
+    return cache_dir
+
+
+class DatasetCache:
+    """
+    Reader for a dataset cache.
+    Examples are returned as lightweight records (see `object_models.AspectLinkRecord`) exposing the same attributes
+    as the Pykson models. Entity records are interned, so every occurrence of an entity is the same object.
+    Location, mentions and the aspect content text are not cached and are None.
+    """
+
+    def __init__(self, cache_dir: str):
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            self.meta: Dict[str, Any] = json.load(f)
+        self._strings = {name: _StringColumn(os.path.join(cache_dir, name)) for name in STRING_COLUMNS}
+        self._lists = {name: _ListColumn(os.path.join(cache_dir, name)) for name in LIST_COLUMNS}
+        self._example_aspects = np.load(os.path.join(cache_dir, 'example_aspects.npy'), mmap_mode='r')
+        entities = self._strings['entities']
+        self.entity_ids: List[str] = [entities[i] for i in range(len(entities))]
+        self._entity_records: List[Optional[EntityRecord]] = [None] * len(self.entity_ids)
+
+    def __len__(self) -> int:
+        return self.meta['num_examples']
+
+    def _entities(self, values: np.ndarray) -> List[EntityRecord]:
+        res: List[EntityRecord] = []
+        for i in values.tolist():
+            record = self._entity_records[i]
+            if record is None:
+                record = self._entity_records[i] = EntityRecord(entity_id=self.entity_ids[i])
+            res.append(record)
+        return res
+
+    def __getitem__(self, i: int) -> AspectLinkRecord:
+        strings = self._strings
+        lists = self._lists
+        candidate_aspects: List[AspectRecord] = [
+            AspectRecord(
+                aspect_id=strings['aspect_id'][j],
+                aspect_name=strings['aspect_name'][j],
+                aspect_content=AnnotatedTextRecord(entities=self._entities(lists['aspect_entities'][j]))
+            )
+            for j in range(self._example_aspects[i], self._example_aspects[i + 1])
+        ]
+        context = ContextRecord(
+            target_entity=strings['target_entity'][i],
+            sentence=AnnotatedTextRecord(
+                content=strings['sentence'][i],
+                entities=self._entities(lists['sentence_entities'][i])
+            ),
+            paragraph=AnnotatedTextRecord(
+                content=strings['paragraph'][i],
+                entities=self._entities(lists['paragraph_entities'][i])
+            )
+        )
+        return AspectLinkRecord(
+            id=strings['example_id'][i],
+            unhashed_id=strings['unhashed_id'][i],
+            context=context,
+            true_aspect=strings['true_aspect'][i],
+            candidate_aspects=candidate_aspects
+        )
+
+    def examples(self, start: int = 0, stop: Optional[int] = None) -> Iterator[AspectLinkRecord]:
+        stop = len(self) if stop is None else min(stop, len(self))
+        for i in range(start, stop):
+            yield self[i]
+
+    def __iter__(self) -> Iterator[AspectLinkRecord]:
+        return self.examples()
+
+
+def main():
+    parser = argparse.ArgumentParser("Build a pre-parsed cache of a data file.")
+    parser.add_argument("--data", help="Data file.", required=True, type=str)
+    parser.add_argument("--save", help="Cache directory. Default: <data>.cache (picked up automatically).",
+                        default=None, type=str)
+    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+
+    print('Building cache...')
+    cache_dir = build_cache(args.data, args.save)
+    print('[Done].')
+    print('Cache written to ==> {}'.format(cache_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Compact, array-backed table of entity descriptions per query.
+
+Instead of a Dict[query_id, Dict[entity_id, description]] holding its own copy of every string, the table holds:
+    - three string pools (UTF-8 blob + int64 offsets): query ids, entity ids and unique descriptions,
+    - CSR arrays: `query_offsets` (int64) gives, for every query, a range of rows in `pair_entities` and
+      `pair_texts` (int32 indexes into the entity and description pools).
+All data lives in a handful of NumPy arrays. Forked workers share them without copying, and a table saved to disk
+is memory-mapped on load and pickles to just its path, so workers started in any way share it through the OS
+page cache instead of receiving a copy.
+The table is a drop-in replacement for the nested dict: `query_id in table` and `table[query_id]` (a small
+{entity_id: description} dict built on demand) work as before.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from tqdm import tqdm
+from typing import List, Dict, Iterator, Tuple, Optional
+from checkpoint import written_last
+
+
+class StringPool:
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings: List[str]) -> 'StringPool':
+        encoded: List[bytes] = [s.encode('UTF-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'StringPool':
+        mmap_mode = 'r' if mmap else None
+        return cls(np.load(path + '.npy', mmap_mode=mmap_mode), np.load(path + '.offsets.npy', mmap_mode=mmap_mode))
+
+    def save(self, path: str) -> None:
+        np.save(path + '.npy', self.data)
+        np.save(path + '.offsets.npy', self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('UTF-8')
+
+    def __iter__(self) -> Iterator[str]:
+        # One copy of the whole pool, instead of one array slice per string.
+        data: bytes = self.data.tobytes()
+        offsets: List[int] = self.offsets.tolist()
+        for i in range(len(self)):
+            yield data[offsets[i]:offsets[i + 1]].decode('UTF-8')
+
+
+class DescriptionTable:
+    def __init__(
+            self,
+            queries: StringPool,
+            entities: StringPool,
+            texts: StringPool,
+            query_offsets: np.ndarray,
+            pair_entities: np.ndarray,
+            pair_texts: np.ndarray,
+            preprocessed: bool = False,
+            path: Optional[str] = None
+    ):
+        self.queries = queries
+        self.entities = entities
+        self.texts = texts
+        self.query_offsets = query_offsets
+        self.pair_entities = pair_entities
+        self.pair_texts = pair_texts
+        self.preprocessed = preprocessed
+        self.path = path
+        self.query_index: Dict[str, int] = {query_id: i for i, query_id in enumerate(queries)}
+
+    @classmethod
+    def from_triples(cls, triples, preprocessed: bool = False) -> 'DescriptionTable':
+        """
+        Builds a table from (query_id, entity_id, description) triples.
+        A later triple for the same (query_id, entity_id) replaces an earlier one, as in the nested dict.
+        """
+        queries: Dict[str, Dict[int, int]] = {}
+        entities: Dict[str, int] = {}
+        texts: Dict[str, int] = {}
+        for query_id, entity_id, text in triples:
+            entity_num = entities.setdefault(entity_id, len(entities))
+            text_num = texts.setdefault(text, len(texts))
+            queries.setdefault(query_id, {})[entity_num] = text_num
+
+        query_offsets = np.zeros(len(queries) + 1, dtype=np.int64)
+        np.cumsum([len(pairs) for pairs in queries.values()], out=query_offsets[1:])
+        pair_entities = np.fromiter((e for pairs in queries.values() for e in pairs.keys()), dtype=np.int32,
+                                    count=int(query_offsets[-1]))
+        pair_texts = np.fromiter((t for pairs in queries.values() for t in pairs.values()), dtype=np.int32,
+                                 count=int(query_offsets[-1]))
+        return cls(
+            queries=StringPool.from_strings(list(queries.keys())),
+            entities=StringPool.from_strings(list(entities.keys())),
+            texts=StringPool.from_strings(list(texts.keys())),
+            query_offsets=query_offsets,
+            pair_entities=pair_entities,
+            pair_texts=pair_texts,
+            preprocessed=preprocessed
+        )
+
+    @classmethod
+    def from_file(cls, file_path: str) -> 'DescriptionTable':
+        """
+        Builds a table from a raw description file (query_id \t entity_id \t description).
+        """
+        def triples():
+            with open(file_path, 'r') as file:
+                for line in file:
+                    line_parts = line.split("\t")
+                    if len(line_parts) == 3:
+                        yield line_parts[0], line_parts[1], line_parts[2]
+
+        return cls.from_triples(tqdm(triples(), desc='Reading descriptions'))
+
+    @classmethod
+    def from_store(cls, store_dir: str) -> 'DescriptionTable':
+        """
+        Builds a table from a preprocessed description store (see `preprocess_descriptions.py`).
+        """
+        if not os.path.exists(os.path.join(store_dir, 'store.json')):
+            raise ValueError('{} is not a complete description store (no store.json); run preprocess_descriptions.py '
+                             'again.'.format(store_dir))
+        with open(os.path.join(store_dir, 'texts.txt'), 'r') as file:
+            texts: List[str] = [line.rstrip('\n') for line in file]
+
+        def triples():
+            with open(os.path.join(store_dir, 'index.tsv'), 'r') as file:
+                for line in file:
+                    line_parts = line.rstrip('\n').split("\t")
+                    if len(line_parts) == 3:
+                        yield line_parts[0], line_parts[1], texts[int(line_parts[2])]
+
+        return cls.from_triples(tqdm(triples(), desc='Reading descriptions'), preprocessed=True)
+
+    @staticmethod
+    def is_table(path: str) -> bool:
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, 'description_table.json'))
+
+    @classmethod
+    def load(cls, table_dir: str, mmap: bool = True) -> 'DescriptionTable':
+        with open(os.path.join(table_dir, 'description_table.json'), 'r') as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        return cls(
+            queries=StringPool.load(os.path.join(table_dir, 'queries'), mmap),
+            entities=StringPool.load(os.path.join(table_dir, 'entities'), mmap),
+            texts=StringPool.load(os.path.join(table_dir, 'texts'), mmap),
+            query_offsets=np.load(os.path.join(table_dir, 'query_offsets.npy'), mmap_mode=mmap_mode),
+            pair_entities=np.load(os.path.join(table_dir, 'pair_entities.npy'), mmap_mode=mmap_mode),
+            pair_texts=np.load(os.path.join(table_dir, 'pair_texts.npy'), mmap_mode=mmap_mode),
+            preprocessed=meta['preprocessed'],
+            path=table_dir if mmap else None
+        )
+
+    def save(self, table_dir: str) -> None:
+        os.makedirs(table_dir, exist_ok=True)
+        meta = {'preprocessed': self.preprocessed, 'num_queries': len(self.queries)}
+        # `load_table` loads a directory as a saved table only if it has a description_table.json (see `is_table`).
+        with written_last(os.path.join(table_dir, 'description_table.json'), meta):
+            self.queries.save(os.path.join(table_dir, 'queries'))
+            self.entities.save(os.path.join(table_dir, 'entities'))
+            self.texts.save(os.path.join(table_dir, 'texts'))
+            np.save(os.path.join(table_dir, 'query_offsets.npy'), self.query_offsets)
+            np.save(os.path.join(table_dir, 'pair_entities.npy'), self.pair_entities)
+            np.save(os.path.join(table_dir, 'pair_texts.npy'), self.pair_texts)
+
+    def __reduce_ex__(self, protocol):
+        # A memory-mapped table is sent to other processes as its path; they map the same files.
+        if self.path is not None:
+            return DescriptionTable.load, (self.path,)
+        return super().__reduce_ex__(protocol)
+
+    def __len__(self) -> int:
+        return len(self.queries)
+
+    def __contains__(self, query_id: str) -> bool:
+        return query_id in self.query_index
+
+    def rows(self, query_id: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Entity numbers and description numbers of a query.
+        """
+        i = self.query_index[query_id]
+        start, end = self.query_offsets[i], self.query_offsets[i + 1]
+        return self.pair_entities[start:end], self.pair_texts[start:end]
+
+    def __getitem__(self, query_id: str) -> Dict[str, str]:
+        entity_nums, text_nums = self.rows(query_id)
+        return {self.entities[e]: self.texts[t] for e, t in zip(entity_nums.tolist(), text_nums.tolist())}
+
+    def get(self, query_id: str, default=None):
+        return self[query_id] if query_id in self else default
+
+
+def load_table(path: str) -> DescriptionTable:
+    """
+    Loads a saved table (memory-mapped), or builds one from a preprocessed store or a raw description file.
+    """
+    if DescriptionTable.is_table(path):
+        return DescriptionTable.load(path)
+    if os.path.isdir(path):
+        return DescriptionTable.from_store(path)
+    return DescriptionTable.from_file(path)
+
+
+def main():
+    parser = argparse.ArgumentParser("Convert entity descriptions to a compact description table.")
+    parser.add_argument("--desc", help='File containing entity description (or a preprocessed description store).',
+                        required=True, type=str)
+    parser.add_argument("--save", help="Output directory.", required=True, type=str)
+    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+
+    print('Reading description file....')
+    table: DescriptionTable = load_table(args.desc)
+    print('[Done].')
+    print('Queries = {}, entities = {}, unique descriptions = {}'.format(
+        len(table.queries), len(table.entities), len(table.texts)))
+
+    print('Writing to file...')
+    table.save(args.save)
+    print('[Done].')
+    print('Table written to ==> {}'.format(args.save))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import numpy as np
+from typing import List, Dict, Tuple, Sequence, Iterable
+from embedding_store import EmbeddingStore
+
+
+class EntityScorer:
+    """
+    Vectorized relatedness scorer over an embedding table.
+    The score of a candidate entity is the sum of its cosine similarities with the context entities (a context entity
+    mentioned twice counts twice, entities without an embedding are skipped).
+    Since sum_c cos(t, c) = t/|t| . sum_c c/|c|, every candidate of an example is scored with one matrix product
+    against the sum of the unit-length context vectors.
+    """
+
+    def __init__(self, embeddings: np.ndarray, entity_ids: Sequence[str], chunk_size: int = 65536):
+        """
+        :param embeddings: Matrix of shape (num_entities, dim). May be a memory-mapped array.
+        :param entity_ids: Entity id for every row of `embeddings`.
+        :param chunk_size: Number of rows to read at a time when computing the row norms.
+        """
+        if len(entity_ids) != embeddings.shape[0]:
+            raise ValueError('Number of entity ids ({}) does not match number of rows ({}).'.format(
+                len(entity_ids), embeddings.shape[0]))
+        self.embeddings = embeddings
+        self.index: Dict[str, int] = {entity_id: row for row, entity_id in enumerate(entity_ids)}
+        self.inv_norms: np.ndarray = self._inverse_norms(embeddings, chunk_size)
+
+    @classmethod
+    def from_dict(cls, entity_embeddings: Dict[str, List[float]]) -> 'EntityScorer':
+        return cls.from_store(EmbeddingStore.from_dict(entity_embeddings))
+
+    @classmethod
+    def from_store(cls, store: EmbeddingStore) -> 'EntityScorer':
+        return cls(store.vectors, store.entity_ids)
+
+    @staticmethod
+    def _inverse_norms(embeddings: np.ndarray, chunk_size: int) -> np.ndarray:
+        # Computed once, chunk by chunk, so that a memory-mapped table is never copied into RAM.
+        # Zero vectors get an inverse norm of 0 and hence a similarity of 0 with everything.
+        inv_norms = np.zeros(embeddings.shape[0], dtype=np.float32)
+        for start in range(0, embeddings.shape[0], chunk_size):
+            chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+            norms = np.linalg.norm(chunk, axis=1)
+            inv_norms[start:start + chunk_size] = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        return inv_norms
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self.index
+
+    def rows(self, entity_ids: Iterable[str]) -> np.ndarray:
+        """
+        Row numbers of the entities that have an embedding. Unknown entities are skipped.
+        Duplicates are kept, so a context entity mentioned twice is counted twice.
+        """
+        return np.fromiter((self.index[e] for e in entity_ids if e in self.index), dtype=np.int64)
+
+    def unit_vectors(self, rows: np.ndarray) -> np.ndarray:
+        """
+        L2-normalized embeddings of the given rows.
+        """
+        return np.asarray(self.embeddings[rows], dtype=np.float32) * self.inv_norms[rows, None]
+
+    def context_vector(self, context_entities: Iterable[str]) -> np.ndarray:
+        """
+        Sum of the unit-length embeddings of the context entities.
+        """
+        rows = self.rows(context_entities)
+        if len(rows) == 0:
+            return np.zeros(self.embeddings.shape[1], dtype=np.float32)
+        return self.unit_vectors(rows).sum(axis=0)
+
+    def score(self, context_entities: Iterable[str], candidate_entities: Iterable[str]) -> Dict[str, float]:
+        """
+        Score the candidate entities of one example.
+        Candidates without an embedding get a score of 0.0.
+        """
+        return self.score_batch([(context_entities, candidate_entities)])[0]
+
+    def score_batch(
+            self,
+            batch: Sequence[Tuple[Iterable[str], Iterable[str]]]
+    ) -> List[Dict[str, float]]:
+        """
+        Score many examples at once.
+        The candidates of all examples are stacked into one matrix and multiplied row-wise with the context vector
+        of the example they belong to.
+        :param batch: List of (context_entities, candidate_entities) pairs.
+        :return: One {entity_id: score} dict per example, in input order.
+        """
+        candidates: List[List[str]] = [list(candidate_entities) for _, candidate_entities in batch]
+        context_vectors = np.stack([self.context_vector(context_entities) for context_entities, _ in batch]) \
+            if batch else np.zeros((0, self.embeddings.shape[1]), dtype=np.float32)
+
+        known_ids: List[str] = []
+        known_rows: List[int] = []
+        owners: List[int] = []
+        for example_num, candidate_entities in enumerate(candidates):
+            for entity_id in candidate_entities:
+                if entity_id in self.index:
+                    known_ids.append(entity_id)
+                    known_rows.append(self.index[entity_id])
+                    owners.append(example_num)
+
+        results: List[Dict[str, float]] = [dict.fromkeys(candidate_entities, 0.0) for candidate_entities in candidates]
+        if not known_rows:
+            return results
+
+        unit = self.unit_vectors(np.asarray(known_rows, dtype=np.int64))
+        scores = np.einsum('ij,ij->i', unit, context_vectors[np.asarray(owners, dtype=np.int64)])
+        for entity_id, example_num, score in zip(known_ids, owners, scores.tolist()):
+            results[example_num][entity_id] = score
+        return results
@@ -0,0 +1,177 @@
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+from typing import List, Dict, Sequence, Optional
+import quantization
+
+
+class EmbeddingStore:
+    """
+    Binary entity embedding store.
+    On disk, a store consists of two files:
+        1. <name>.npy: float32 matrix of shape (num_entities, dim).
+        2. <name>.ids: entity id of every row, one per line.
+    The matrix is memory-mapped on load, so startup does not depend on the size of the table and several processes
+    reading the same store share its pages through the OS page cache.
+    A store may also be quantized (float16, int8 or pq, see `quantization.py`); `vectors` is then the quantized table,
+    which decodes rows as they are read.
+    """
+
+    def __init__(self, vectors: np.ndarray, entity_ids: List[str]):
+        if len(entity_ids) != vectors.shape[0]:
+            raise ValueError('Number of entity ids ({}) does not match number of rows ({}).'.format(
+                len(entity_ids), vectors.shape[0]))
+        self.vectors = vectors
+        self.entity_ids = entity_ids
+        self.index: Dict[str, int] = {entity_id: row for row, entity_id in enumerate(entity_ids)}
+
+    def __len__(self) -> int:
+        return len(self.entity_ids)
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self.index
+
+    def __getitem__(self, entity_id: str) -> np.ndarray:
+        return self.vectors[self.index[entity_id]]
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'EmbeddingStore':
+        vectors_file, ids_file = store_files(path)
+        return cls(quantization.load_matrix(vectors_file, mmap), read_ids(ids_file))
+
+    @classmethod
+    def from_dict(cls, entity_embeddings: Dict[str, List[float]]) -> 'EmbeddingStore':
+        entity_ids: List[str] = list(entity_embeddings.keys())
+        vectors = np.asarray([entity_embeddings[entity_id] for entity_id in entity_ids], dtype=np.float32)
+        return cls(vectors.reshape(len(entity_ids), -1), entity_ids)
+
+    def save(self, path: str) -> None:
+        save_store(path, self.entity_ids, self.vectors)
+
+
+def store_files(path: str):
+    """
+    Returns the (matrix, ids) file names of the store at `path`, with or without the `.npy` extension.
+    """
+    if path.endswith('.npy'):
+        path = path[:-len('.npy')]
+    return path + '.npy', path + '.ids'
+
+
+def read_ids(ids_file: str) -> List[str]:
+    with open(ids_file, 'r') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def ids_digest(entity_ids: Sequence[str]) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for entity_id in entity_ids:
+        digest.update(entity_id.encode('UTF-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def save_store(path: str, entity_ids: Sequence[str], vectors: np.ndarray) -> None:
+    vectors_file, ids_file = store_files(path)
+    quantization.remove_side_files(vectors_file)
+    np.save(vectors_file, np.asarray(vectors[:], dtype=np.float32))
+    with open(ids_file, 'w') as f:
+        for entity_id in entity_ids:
+            f.write("%s\n" % entity_id)
+
+
+def create_store(path: str, entity_ids: Sequence[str], dim: int) -> np.ndarray:
+    """
+    Creates a store of the given entities and returns its (memory-mapped, writable) matrix, so that it can be
+    filled chunk by chunk without holding the whole matrix in memory. The ids file is written first.
+    """
+    vectors_file, ids_file = store_files(path)
+    quantization.remove_side_files(vectors_file)
+    with open(ids_file, 'w') as f:
+        for entity_id in entity_ids:
+            f.write("%s\n" % entity_id)
+    return np.lib.format.open_memmap(vectors_file, mode='w+', dtype=np.float32, shape=(len(entity_ids), dim))
+
+
+def quantized_path(path: str, method: str) -> str:
+    """
+    Path of the `method` quantized copy of the store at `path`: <name>.<method>.npy next to <name>.npy.
+    """
+    return store_files(path)[0][:-len('.npy')] + '.' + method + '.npy'
+
+
+def quantize_store(
+        path: str,
+        save: str,
+        method: str,
+        chunk_size: int = 65536,
+        num_subspaces: Optional[int] = None
+) -> EmbeddingStore:
+    """
+    Writes a quantized copy of the store at `path` to `save` (see `quantization.quantize_matrix`) and returns it.
+    """
+    store: EmbeddingStore = EmbeddingStore.load(path)
+    vectors_file, ids_file = store_files(save)
+    vectors = quantization.quantize_matrix(store.vectors, vectors_file, method, chunk_size, num_subspaces)
+    with open(ids_file, 'w') as f:
+        for entity_id in store.entity_ids:
+            f.write("%s\n" % entity_id)
+    return EmbeddingStore(vectors, store.entity_ids)
+
+
+def load_embeddings(path: str) -> EmbeddingStore:
+    """
+    Load a binary store (memory-mapped), a JSON-L file of {"entity_id": ..., "vector": [floats]} lines or, for
+    backward compatibility, a JSON file of {entity_id: [floats]}.
+    """
+    if path.endswith('.npy'):
+        return EmbeddingStore.load(path)
+    if path.endswith('.jsonl'):
+        with open(path, 'r') as f:
+            rows = [json.loads(line) for line in f]
+        return EmbeddingStore.from_dict({row['entity_id']: row['vector'] for row in rows})
+    with open(path, 'r') as f:
+        return EmbeddingStore.from_dict(json.load(f))
+
+
+def main():
+    parser = argparse.ArgumentParser("Convert a JSON embedding file to a binary embedding store.")
+    parser.add_argument("--embeddings", help="JSON file of {entity_id: [floats]} (or JSON-L file, or a binary store "
+                                             "to quantize).", required=True, type=str)
+    parser.add_argument("--save", help="Output store (.npy file).", required=True, type=str)
+    parser.add_argument("--quantize", help="Also write a quantized copy of the store to <save>.<method>.npy "
+                                           "(float16|int8|pq). Default: none.", default=None,
+                        choices=quantization.METHODS)
+    parser.add_argument("--pq-subspaces", help="pq: Number of sub-vectors, i.e., bytes per entity. "
+                                               "Default: dimension / 4.", default=None, type=int)
+    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+
+    print('Loading entity embeddings...')
+    store: EmbeddingStore = load_embeddings(args.embeddings)
+    print('[Done].')
+
+    if store_files(args.embeddings)[0] != store_files(args.save)[0]:
+        print('Writing to file...')
+        store.save(args.save)
+        print('[Done].')
+        print('Store written to ==> {}'.format(store_files(args.save)[0]))
+
+    if args.quantize is not None:
+        print('Quantizing...')
+        quantized_file: str = quantized_path(args.save, args.quantize)
+        quantized: EmbeddingStore = quantize_store(args.save, quantized_file, args.quantize,
+                                                   num_subspaces=args.pq_subspaces)
+        print('[Done].')
+        for line in quantization.memory_lines(quantized.vectors):
+            print(line)
+        print('Quantized store written to ==> {}'.format(quantized_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Streaming, resumable writer for the output of the embedding converters.
+
+Rows are written in chunks, in a fixed order of entity ids, and committed after every chunk: the output is flushed
+to disk and the number of rows done (and, for text formats, the size of the file) is written to
+`<output>.checkpoint` (see `checkpoint.py`). Peak memory is one chunk, and with `resume` an interrupted conversion
+continues after the last committed chunk. Formats:
+    - npy: a binary embedding store (see `embedding_store.py`), created at full size and filled in place.
+    - json: one {entity_id: [floats]} object, as written by `json.dump`, streamed entry by entry.
+    - jsonl: one {"entity_id": ..., "vector": [...]} object per line.
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from typing import List, Dict, Tuple, Iterable, Callable, Optional
+import embedding_store
+import entity_resolution
+import quantization
+from checkpoint import read_checkpoint, write_checkpoint, truncate_uncommitted
+
+FORMATS = ('json', 'jsonl', 'npy')
+
+
+class EmbeddingWriter:
+    def __init__(self, out_file: str, fmt: str, entity_ids: List[str], dim: int, resume: bool = False):
+        """
+        :param out_file: Output file.
+        :param fmt: One of `FORMATS`.
+        :param entity_ids: Entity id of every row, in the order in which the rows will be written.
+        :param dim: Dimension of the vectors.
+        :param resume: Continue from the checkpoint of `out_file`, if there is one written for the same entities.
+        """
+        if fmt not in FORMATS:
+            raise ValueError('Format must be one of {}.'.format(', '.join(FORMATS)))
+        self.out_file = out_file
+        self.fmt = fmt
+        self.entity_ids = entity_ids
+        self.checkpoint = {'format': fmt, 'num_rows': len(entity_ids), 'dim': dim,
+                           'ids_digest': embedding_store.ids_digest(entity_ids),
+                           'rows_done': 0, 'size': 0, 'complete': False}
+
+        previous = read_checkpoint(out_file) if resume else None
+        if previous is not None:
+            if any(previous[key] != self.checkpoint[key] for key in ('format', 'num_rows', 'dim', 'ids_digest')):
+                raise ValueError('Checkpoint of {} was written for a different conversion.'.format(out_file))
+            self.checkpoint = previous
+            print('Resuming after {} rows.'.format(self.rows_done))
+
+        if fmt == 'npy':
+            if previous is None:
+                self.matrix = embedding_store.create_store(out_file, entity_ids, dim)
+            else:
+                self.matrix = np.load(embedding_store.store_files(out_file)[0], mmap_mode='r+')
+        else:
+            # The text formats are appended to, so a partly written chunk of rows is cut off here.
+            truncate_uncommitted(out_file, self.checkpoint)
+            if previous is None and fmt == 'json':
+                self._append('{')
+        write_checkpoint(out_file, self.checkpoint)
+
+    @property
+    def rows_done(self) -> int:
+        return self.checkpoint['rows_done']
+
+    @property
+    def complete(self) -> bool:
+        return self.checkpoint['complete']
+
+    def write(self, vectors: np.ndarray) -> None:
+        """
+        Writes and commits the next `len(vectors)` rows.
+        """
+        start, end = self.rows_done, self.rows_done + len(vectors)
+        if self.fmt == 'npy':
+            self.matrix[start:end] = vectors
+            self.matrix.flush()
+        elif self.fmt == 'json':
+            entries: List[str] = ['{}: {}'.format(json.dumps(entity_id), json.dumps(vector))
+                                  for entity_id, vector in zip(self.entity_ids[start:end], vectors.tolist())]
+            self._append((', ' if start > 0 else '') + ', '.join(entries))
+        else:
+            self._append(''.join(json.dumps({'entity_id': entity_id, 'vector': vector}) + '\n'
+                                 for entity_id, vector in zip(self.entity_ids[start:end], vectors.tolist())))
+        self.checkpoint['rows_done'] = end
+        write_checkpoint(self.out_file, self.checkpoint)
+
+    def close(self) -> None:
+        """
+        Completes the output (all rows must have been written).
+        """
+        if self.complete:
+            return
+        if self.rows_done != len(self.entity_ids):
+            raise ValueError('{} of {} rows written.'.format(self.rows_done, len(self.entity_ids)))
+        if self.fmt == 'json':
+            self._append('}')
+        self.checkpoint['complete'] = True
+        write_checkpoint(self.out_file, self.checkpoint)
+
+    def _append(self, text: str) -> None:
+        with open(self.out_file, 'a', encoding='UTF-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        self.checkpoint['size'] = os.path.getsize(self.out_file)
+
+
+def convert_rows(
+        chunks: Callable[[np.ndarray], Iterable[Tuple[int, np.ndarray]]],
+        entity_ids: List[str],
+        rows: np.ndarray,
+        dim: int,
+        out_file: Optional[str] = None,
+        fmt: str = 'npy',
+        resume: bool = False
+) -> Optional[Dict[str, List[float]]]:
+    """
+    Converts the embeddings of the given model rows, as the embedding converters do.
+    :param chunks: Yields (start, vectors) of consecutive chunks of the given rows, in their order.
+    :param entity_ids: Entity id of every row.
+    :param out_file: Stream the vectors to this file in format `fmt` and return None. Default: return a dict.
+    :param resume: Continue an interrupted conversion to `out_file` after its last committed chunk.
+    :return: {entity_id: vector}, if there is no `out_file`.
+    """
+    if out_file is not None:
+        writer = EmbeddingWriter(out_file, fmt, entity_ids, dim, resume)
+        for _, chunk in chunks(rows[writer.rows_done:]):
+            writer.write(chunk)
+        writer.close()
+        return None
+
+    id2vec: Dict[str, List[float]] = {}
+    for start, chunk in chunks(rows):
+        id2vec.update(zip(entity_ids[start:start + len(chunk)], chunk.tolist()))
+    return id2vec
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds the output options shared by the embedding converters (--save and --wiki2vec are theirs).
+    """
+    parser.add_argument("--format", help="Output format (json|jsonl|npy). Default: json.", default='json',
+                        choices=FORMATS)
+    parser.add_argument("--chunk-size", help="Number of entities to convert at a time. Default: 65536.",
+                        default=65536, type=int)
+    parser.add_argument("--resolution-cache", help="Saved CAR entity to embedding row mapping (see "
+                                                   "entity_resolution.py); built on first use. "
+                                                   "Default: <save>/<model file>.entity_rows.", default=None)
+    parser.add_argument("--resume", help="Continue an interrupted conversion after its last committed chunk.",
+                        action='store_true')
+    parser.add_argument("--quantize", help="npy: Also write a quantized copy of the store (float16|int8|pq, see "
+                                           "quantization.py). Default: none.", default=None,
+                        choices=quantization.METHODS)
+
+
+def check_arguments(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    if args.quantize is not None and args.format != 'npy':
+        parser.error('--quantize requires --format npy.')
+
+
+def resolution_cache(args: argparse.Namespace) -> str:
+    return args.resolution_cache if args.resolution_cache is not None else \
+        entity_resolution.default_path(args.save, args.wiki2vec)
+
+
+def finish(out_file: str, unknown: List[str], args: argparse.Namespace) -> None:
+    """
+    Quantizes the converted store if asked to, and writes the CAR entities without an embedding to
+    <save>/unknown_car_entities.txt.
+    """
+    if args.quantize is not None:
+        print('Quantizing...')
+        quantized_file: str = embedding_store.quantized_path(out_file, args.quantize)
+        quantized = embedding_store.quantize_store(out_file, quantized_file, args.quantize, args.chunk_size)
+        print('[Done].')
+        for line in quantization.memory_lines(quantized.vectors):
+            print(line)
+        print('Quantized embeddings written to ==> {}'.format(quantized_file))
+
+    print('Writing to file..')
+    with open(os.path.join(args.save, 'unknown_car_entities.txt'), 'w') as f:
+        f.write("%s\n" % len(unknown))
+        for item in unknown:
+            f.write("%s\n" % item)
+    print('[Done].')
@@ -0,0 +1,247 @@
+"""
+Approximate nearest-neighbour (ANN) index over an embedding store, for retrieving guiding entities from the whole
+embedding table instead of only scoring the candidate entities of an example.
+
+The index holds the unit-length embedding of every entity, and is searched by inner product. Searched with the sum of
+the unit-length context vectors (`EntityScorer.context_vector`, i.e., the centroid direction of the context), the
+score of a retrieved entity is exactly its score in candidate mode: the sum of its cosine similarities with the
+context entities.
+
+Index types:
+    - hnsw: graph index (faiss `IndexHNSWFlat`). No training, fast and accurate; the default.
+    - ivf: inverted file index (faiss `IndexIVFFlat`), trained on a sample of the table. Smaller and faster to build.
+    - flat: exact search over the (memory-mapped) table with NumPy. Needs no extra package and no index file.
+hnsw and ivf require the `faiss` package (`pip install faiss-cpu`).
+
+An index is built once and saved next to the store as two files:
+    1. <name>.faiss: the faiss index (not written for `flat`).
+    2. <name>.json: index type and parameters, and a digest of the entity ids of the store it was built from.
+Loading an index checks the digest, so an index is never used with a different store.
+`load_or_build` rebuilds a saved index whose type is not the one asked for.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from tqdm import tqdm
+from typing import List, Tuple, Optional
+from embedding_scorer import EntityScorer
+from embedding_store import EmbeddingStore, load_embeddings, ids_digest
+from checkpoint import written_last
+
+INDEX_TYPES = ('hnsw', 'ivf', 'flat')
+
+
+def index_files(path: str) -> Tuple[str, str]:
+    """
+    Returns the (faiss index, metadata) file names of the index at `path`.
+    """
+    if path.endswith('.faiss'):
+        path = path[:-len('.faiss')]
+    return path + '.faiss', path + '.json'
+
+
+def _faiss():
+    try:
+        import faiss
+    except ImportError:
+        raise ImportError('Index types `hnsw` and `ivf` require the `faiss` package (pip install faiss-cpu). '
+                          'Use --index-type flat for exact search without it.')
+    return faiss
+
+
+class EntityIndex:
+    def __init__(self, scorer: EntityScorer, entity_ids: List[str], index_type: str = 'hnsw', index=None,
+                 params: Optional[dict] = None):
+        """
+        :param scorer: Scorer over the store the index was built from (used for unit vectors and `flat` search).
+        :param entity_ids: Entity id of every row of the store.
+        :param index_type: One of `INDEX_TYPES`.
+        :param index: The faiss index (None for `flat`).
+        :param params: Index parameters (see `build`).
+        """
+        if index_type not in INDEX_TYPES:
+            raise ValueError('Index type must be one of {}.'.format(', '.join(INDEX_TYPES)))
+        self.scorer = scorer
+        self.entity_ids = entity_ids
+        self.index_type = index_type
+        self.index = index
+        self.params = params or {}
+        # Search parameters; not part of the saved index.
+        self.ef_search: int = 128
+        self.nprobe: int = 16
+
+    @classmethod
+    def build(
+            cls,
+            store: EmbeddingStore,
+            scorer: Optional[EntityScorer] = None,
+            index_type: str = 'hnsw',
+            m: int = 32,
+            ef_construction: int = 200,
+            nlist: Optional[int] = None,
+            chunk_size: int = 65536
+    ) -> 'EntityIndex':
+        """
+        Builds an index over all entities of `store`, adding the unit vectors chunk by chunk.
+        :param m: hnsw: number of neighbours per node.
+        :param ef_construction: hnsw: size of the candidate list while building.
+        :param nlist: ivf: number of clusters. Default: 4 * sqrt(num_entities).
+        :param chunk_size: Number of rows to add at a time.
+        """
+        scorer = scorer if scorer is not None else EntityScorer.from_store(store)
+        num_entities, dim = store.vectors.shape
+        params: dict = {}
+        if index_type == 'flat':
+            return cls(scorer, store.entity_ids, index_type, None, params)
+
+        faiss = _faiss()
+        if index_type == 'hnsw':
+            params = {'m': m, 'ef_construction': ef_construction}
+            index = faiss.IndexHNSWFlat(dim, m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = ef_construction
+        elif index_type == 'ivf':
+            nlist = nlist if nlist is not None else max(1, int(4 * np.sqrt(num_entities)))
+            params = {'nlist': nlist}
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            # Train on a sample of at most 256 vectors per cluster (faiss recommends 30 to 256).
+            sample = np.random.RandomState(0).permutation(num_entities)[:256 * nlist]
+            index.train(scorer.unit_vectors(np.sort(sample)))
+        else:
+            raise ValueError('Index type must be one of {}.'.format(', '.join(INDEX_TYPES)))
+
+        for start in tqdm(range(0, num_entities, chunk_size), desc='Building index'):
+            rows = np.arange(start, min(start + chunk_size, num_entities), dtype=np.int64)
+            index.add(np.ascontiguousarray(scorer.unit_vectors(rows)))
+        return cls(scorer, store.entity_ids, index_type, index, params)
+
+    def save(self, path: str) -> None:
+        index_file, meta_file = index_files(path)
+        meta = {
+            'index_type': self.index_type,
+            'params': self.params,
+            'num_entities': len(self.entity_ids),
+            'ids_digest': ids_digest(self.entity_ids)
+        }
+        # `load_or_build` may be replacing an index of another type at `path`: until the new .faiss file is
+        # complete, there is no metadata, and the next run rebuilds instead of reading a partial index.
+        with written_last(meta_file, meta):
+            if self.index is not None:
+                _faiss().write_index(self.index, index_file)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(index_files(path)[1])
+
+    @classmethod
+    def load(cls, path: str, store: EmbeddingStore, scorer: Optional[EntityScorer] = None) -> 'EntityIndex':
+        index_file, meta_file = index_files(path)
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        if meta['num_entities'] != len(store) or meta['ids_digest'] != ids_digest(store.entity_ids):
+            raise ValueError('Index {} was built from a different embedding store.'.format(path))
+        index = _faiss().read_index(index_file) if meta['index_type'] != 'flat' else None
+        scorer = scorer if scorer is not None else EntityScorer.from_store(store)
+        return cls(scorer, store.entity_ids, meta['index_type'], index, meta['params'])
+
+    @staticmethod
+    def saved_type(path: str) -> Optional[str]:
+        """
+        Type of the index saved at `path`, or None if there is none.
+        """
+        if not EntityIndex.exists(path):
+            return None
+        with open(index_files(path)[1], 'r') as f:
+            return json.load(f)['index_type']
+
+    @classmethod
+    def load_or_build(cls, path: str, store: EmbeddingStore, scorer: Optional[EntityScorer] = None,
+                      index_type: str = 'hnsw') -> 'EntityIndex':
+        """
+        Loads the index at `path` if it is of type `index_type`; otherwise builds one and saves it there
+        (replacing an index of another type).
+        """
+        saved_type: Optional[str] = cls.saved_type(path)
+        if saved_type == index_type:
+            return cls.load(path, store, scorer)
+        if saved_type is not None:
+            print('Index {} is of type {}, rebuilding it as {}.'.format(path, saved_type, index_type))
+        index = cls.build(store, scorer, index_type)
+        index.save(path)
+        return index
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k entities by inner product with each query vector.
+        Accuracy is controlled by `ef_search` (hnsw: size of the candidate list, at least k) and
+        `nprobe` (ivf: number of clusters to visit).
+        :param queries: Matrix of shape (num_queries, dim).
+        :return: (scores, rows), both of shape (num_queries, k), best first. Missing results have row -1.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if self.index_type == 'flat':
+            return self._exact_search(queries, k)
+        if self.index_type == 'hnsw':
+            self.index.hnsw.efSearch = max(self.ef_search, k)
+        else:
+            self.index.nprobe = self.nprobe
+        return self.index.search(queries, k)
+
+    def _exact_search(self, queries: np.ndarray, k: int, chunk_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+        # Keeps the running top-k of every query while scanning the table chunk by chunk.
+        num_entities = len(self.entity_ids)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, num_entities, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, num_entities), dtype=np.int64)
+            scores = queries @ self.scorer.unit_vectors(rows).T
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, np.broadcast_to(rows, scores.shape)], axis=1)
+            if best_scores.shape[1] > k:
+                top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        if best_scores.shape[1] < k:
+            pad = k - best_scores.shape[1]
+            best_scores = np.pad(best_scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+            best_rows = np.pad(best_rows, ((0, 0), (0, pad)), constant_values=-1)
+        return best_scores, best_rows
+
+
+def main():
+    parser = argparse.ArgumentParser("Build an approximate nearest-neighbour index over an embedding store.")
+    parser.add_argument("--embeddings", help="Embedding File (binary .npy store or JSON).", required=True, type=str)
+    parser.add_argument("--save", help="Output index (.faiss file; metadata is written next to it).",
+                        required=True, type=str)
+    parser.add_argument("--index-type", help="Index type (hnsw|ivf|flat). Default: hnsw.", default='hnsw',
+                        choices=INDEX_TYPES)
+    parser.add_argument("--m", help="hnsw: number of neighbours per node. Default: 32.", default=32, type=int)
+    parser.add_argument("--ef-construction", help="hnsw: candidate list size while building. Default: 200.",
+                        default=200, type=int)
+    parser.add_argument("--nlist", help="ivf: number of clusters. Default: 4 * sqrt(number of entities).",
+                        default=None, type=int)
+    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+
+    print('Loading entity embeddings...')
+    store: EmbeddingStore = load_embeddings(args.embeddings)
+    print('[Done].')
+
+    print('Building index...')
+    index = EntityIndex.build(store, index_type=args.index_type, m=args.m, ef_construction=args.ef_construction,
+                              nlist=args.nlist)
+    print('[Done].')
+
+    print('Writing to file...')
+    index.save(args.save)
+    print('[Done].')
+    print('Index written to ==> {}'.format(index_files(args.save)[1 if args.index_type == 'flat' else 0]))
+
+
+if __name__ == '__main__':
+    main()
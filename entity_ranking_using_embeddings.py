@@ -1,14 +1,17 @@
-import json
-import requests
-import gzip
 import sys
-from tqdm import tqdm
 import os
 import argparse
-from scipy import spatial
-import operator
+from scipy import stats
+import itertools
+import numpy as np
 import utils
-from typing import List, Dict, Set, Tuple, Any
+import sharding
+import trec_io
+import quantization
+from embedding_scorer import EntityScorer
+from embedding_store import EmbeddingStore, load_embeddings
+from entity_index import EntityIndex, INDEX_TYPES
+from typing import List, Dict, Set, Tuple, Any, Iterable, Iterator, Optional
 from object_models import Location, Entity, AnnotatedText, AspectLinkExample, Aspect, Context
 
 totals = {
@@ -29,92 +32,219 @@ def get_candidate_entity_set(example: AspectLinkExample) -> Set[str]:
     return set(entities)
 
 
-def score_entities(
-        context_entities: Set[str],
-        candidate_entities: Set[str],
-        entity_embeddings: Dict[str, List[float]]
-) -> Dict[str, float]:
-    return {
-        entity_id: score_entity(entity_id, context_entities, entity_embeddings)
-        for entity_id in candidate_entities
-    }
-
-
-def score_entity(
-        target_entity: str,
-        context_entities: Set[str],
-        entity_embeddings: Dict[str, List[float]]
-) -> float:
-    if target_entity in entity_embeddings:
-        return sum([
-            cosine_similarity(entity_embeddings[target_entity], entity_embeddings[context_entity])
-            for context_entity in context_entities if context_entity in entity_embeddings
-        ])
-    return 0.0
+def make_run_file_strings(query_id: str, scores: Dict[str, float]) -> List[str]:
+    return list(trec_io.run_lines(query_id, scores.items(), 'Relatedness', skip_zero=True))
 
 
-def cosine_similarity(emb1, emb2):
-    return 1 - spatial.distance.cosine(emb1, emb2)
+def get_context_entities(example: AspectLinkExample, context_type: str) -> List[str]:
+    return utils.get_entity_ids_only(
+        example.context.sentence.entities) if context_type == 'sent' else utils.get_entity_ids_only(
+        example.context.paragraph.entities)
 
 
-def make_run_file_strings(query_id: str, scores: Dict[str, float]) -> List[str]:
-    return [
-        query_id + ' Q0 ' + doc_id + ' ' + str(scores[doc_id]) + ' ' + str(rank + 1) + ' Relatedness'
-        for rank, doc_id in enumerate(scores) if scores[doc_id] != 0
-    ]
+def rank_batch(
+        batch: List[AspectLinkExample],
+        context_type: str,
+        scorer: EntityScorer,
+        top_k: Optional[int] = None
+) -> List[str]:
+    """
+    Ranks the candidate entities of every example. With `top_k`, only the top-k entities of every example are kept.
+    """
+    batch_scores: List[Dict[str, float]] = scorer.score_batch([
+        (get_context_entities(example, context_type), get_candidate_entity_set(example))
+        for example in batch
+    ])
+    run_file_strings: List[str] = []
+    for example, entity_scores in zip(batch, batch_scores):
+        entity_scores = dict(utils.top_k_items(entity_scores, top_k))
+        run_file_strings.extend(make_run_file_strings(query_id=example.id, scores=entity_scores))
+    return run_file_strings
 
 
-def rank_entities(
-        data_file: str,
+def retrieve_batch(
+        batch: List[AspectLinkExample],
         context_type: str,
-        entity_embeddings: Dict[str, List[float]]
+        scorer: EntityScorer,
+        index: EntityIndex,
+        k: int,
+        query: str = 'centroid'
 ) -> List[str]:
-    total = totals[os.path.basename(data_file)]
+    """
+    Retrieves the top-k entities of the whole embedding table for every example, instead of scoring its candidates.
+    With `centroid`, the index is searched once per example with the sum of the unit-length context vectors; the
+    scores it returns are the candidate-mode scores (sum of cosine similarities with the context entities).
+    With `set`, the index is searched with every context entity, and the union of the results is scored exactly.
+    """
+    contexts: List[List[str]] = [get_context_entities(example, context_type) for example in batch]
+    if query == 'centroid':
+        scores, rows = index.search(np.stack([scorer.context_vector(context) for context in contexts]), k)
+        batch_scores: List[Dict[str, float]] = [
+            {index.entity_ids[row]: score for score, row in zip(example_scores, example_rows) if row >= 0}
+            for example_scores, example_rows in zip(scores.tolist(), rows.tolist())
+        ]
+    elif query == 'set':
+        context_rows: List[np.ndarray] = [scorer.rows(context) for context in contexts]
+        all_rows = np.concatenate(context_rows) if context_rows else np.zeros(0, dtype=np.int64)
+        _, neighbours = index.search(scorer.unit_vectors(all_rows), k)
+        owners = np.repeat(np.arange(len(batch)), [len(rows) for rows in context_rows])
+        retrieved: List[Set[str]] = [set() for _ in batch]
+        for example_num, example_rows in zip(owners.tolist(), neighbours.tolist()):
+            retrieved[example_num].update(index.entity_ids[row] for row in example_rows if row >= 0)
+        batch_scores = scorer.score_batch(list(zip(contexts, retrieved)))
+    else:
+        raise ValueError('Query must be `centroid` or `set`.')
 
     run_file_strings: List[str] = []
-    for example in tqdm(utils.aspect_link_examples(data_file), total=total):
-        query_id: str = example.id
-        candidate_entity_set: Set[str] = get_candidate_entity_set(example)
-        context_entity_set: Set[str] = utils.get_entity_ids_only(
-            example.context.sentence.entities) if context_type == 'sent' else get_entity_ids_only(
-            example.context.paragraph.entities)
-        entity_scores: Dict[str, float] = score_entities(
-            context_entities=context_entity_set,
-            candidate_entities=candidate_entity_set,
-            entity_embeddings=entity_embeddings
-        )
-        entity_scores = dict(sorted(entity_scores.items(), key=operator.itemgetter(1), reverse=True))
-        run_file_strings.extend(make_run_file_strings(query_id=query_id, scores=entity_scores))
-
+    for example, entity_scores in zip(batch, batch_scores):
+        entity_scores = dict(utils.top_k_items(entity_scores, k))
+        run_file_strings.extend(make_run_file_strings(query_id=example.id, scores=entity_scores))
     return run_file_strings
 
 
-def write_to_file(data: List[str], output_file: str):
-    with open(output_file, 'a') as f:
-        for d in data:
-            f.write("%s\n" % d)
+def rank_examples(
+        examples: Iterable[AspectLinkExample],
+        context_type: str,
+        scorer: EntityScorer,
+        batch_size: int = 256,
+        index: Optional[EntityIndex] = None,
+        k: int = 100,
+        query: str = 'centroid',
+        top_k: Optional[int] = None
+) -> Iterator[str]:
+    """
+    Ranks the candidate entities of every example or, given an index, retrieves the top-k entities of every example.
+    """
+    for batch in utils.chunked(examples, batch_size):
+        if index is None:
+            yield from rank_batch(batch, context_type, scorer, top_k)
+        else:
+            yield from retrieve_batch(batch, context_type, scorer, index, k, query)
+
+
+def ranking_agreement(
+        examples: Iterable[AspectLinkExample],
+        context_type: str,
+        scorer: EntityScorer,
+        reference: EntityScorer,
+        batch_size: int = 256,
+        k: int = 10
+) -> Dict[str, float]:
+    """
+    Compares the candidate rankings of `scorer` (e.g., over a quantized store) with those of `reference` (e.g., over
+    the full-precision store), averaged over the examples:
+        - top1: the best entity is the same,
+        - overlap@k: fraction of the reference top-k that is also in the top-k,
+        - kendall_tau: rank correlation of all candidate scores (examples with fewer than 2 candidates are skipped),
+        - max_abs_error: largest absolute score difference.
+    """
+    top1: List[float] = []
+    overlap: List[float] = []
+    tau: List[float] = []
+    max_error: float = 0.0
+    for batch in utils.chunked(examples, batch_size):
+        pairs = [(get_context_entities(example, context_type), get_candidate_entity_set(example)) for example in batch]
+        for scores, reference_scores in zip(scorer.score_batch(pairs), reference.score_batch(pairs)):
+            if not scores:
+                continue
+            ranked = [entity_id for entity_id, _ in utils.top_k_items(scores, k)]
+            reference_ranked = [entity_id for entity_id, _ in utils.top_k_items(reference_scores, k)]
+            top1.append(float(ranked[0] == reference_ranked[0]))
+            overlap.append(len(set(ranked) & set(reference_ranked)) / len(reference_ranked))
+            entity_ids: List[str] = list(scores.keys())
+            values = np.asarray([scores[e] for e in entity_ids])
+            reference_values = np.asarray([reference_scores[e] for e in entity_ids])
+            max_error = max(max_error, float(np.abs(values - reference_values).max()))
+            if len(entity_ids) > 1:
+                correlation = stats.kendalltau(values, reference_values)[0]
+                if not np.isnan(correlation):
+                    tau.append(correlation)
+    return {
+        'examples': len(top1),
+        'top1': float(np.mean(top1)) if top1 else 0.0,
+        'overlap@{}'.format(k): float(np.mean(overlap)) if overlap else 0.0,
+        'kendall_tau': float(np.mean(tau)) if tau else 0.0,
+        'max_abs_error': max_error,
+    }
 
 
 def main():
     parser = argparse.ArgumentParser("Rank entities using semantic relatedness.")
     parser.add_argument("--data", help="Data file.", required=True, type=str)
     parser.add_argument("--save", help="Output file.", required=True, type=str)
-    parser.add_argument("--embeddings", help="Embedding File.", required=True, type=str)
+    parser.add_argument("--embeddings", help="Embedding File (binary .npy store or JSON).", required=True, type=str)
     parser.add_argument("--context", help="Type of context to use (sent|para)", required=True, type=str)
+    parser.add_argument("--batch-size", help="Number of examples to score at once. Default: 256.",
+                        default=256, type=int)
+    parser.add_argument("--top-k", help="Keep only the top-k entities of every example (e.g., the --k used by "
+                                        "aspect_ranking_using_entity_ranking). Default: all entities.",
+                        default=None, type=int)
+    parser.add_argument("--mode", help="Rank the candidate entities of every example, or retrieve entities from the "
+                                       "whole embedding table (candidates|retrieve). Default: candidates.",
+                        default='candidates', choices=['candidates', 'retrieve'])
+    parser.add_argument("--index", help="retrieve: Entity index (see entity_index.py). Built and saved here if it "
+                                        "does not exist or is not of --index-type. Default: next to the embedding "
+                                        "store.", default=None, type=str)
+    parser.add_argument("--index-type", help="retrieve: Type of index to build (hnsw|ivf|flat). Default: hnsw.",
+                        default='hnsw', choices=INDEX_TYPES)
+    parser.add_argument("--retrieve-k", help="retrieve: Number of entities to retrieve per example. Default: 100.",
+                        default=100, type=int)
+    parser.add_argument("--query", help="retrieve: Search with the centroid of the context entities or with every "
+                                        "context entity (centroid|set). Default: centroid.",
+                        default='centroid', choices=['centroid', 'set'])
+    parser.add_argument("--ef-search", help="retrieve: hnsw candidate list size while searching. Default: 128.",
+                        default=128, type=int)
+    parser.add_argument("--nprobe", help="retrieve: Number of ivf clusters to visit. Default: 16.",
+                        default=16, type=int)
+    parser.add_argument("--reference", help="Full-precision embedding store to compare --embeddings (e.g., a "
+                                            "quantized store) against: reports the ranking agreement on the first "
+                                            "--report-examples examples and the memory saved.", default=None, type=str)
+    parser.add_argument("--report-examples", help="Number of examples for the --reference report. Default: 1000.",
+                        default=1000, type=int)
+    sharding.add_arguments(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
 
     print('Loading entity embeddings...')
-    with open(args.embeddings, 'r') as f:
-        entity_embeddings: Dict[str, List[float]] = json.load(f)
+    store: EmbeddingStore = load_embeddings(args.embeddings)
+    scorer: EntityScorer = EntityScorer.from_store(store)
     print('[Done].')
+    for line in quantization.memory_lines(store.vectors):
+        print(line)
+
+    fields: Set[str] = {'id', 'sentence' if args.context == 'sent' else 'paragraph', 'aspects'}
+    if args.reference is not None:
+        print('Comparing with the reference embeddings...')
+        reference: EntityScorer = EntityScorer.from_store(load_embeddings(args.reference))
+        examples = itertools.islice(utils.aspect_link_examples(args.data, fields=fields), args.report_examples)
+        agreement: Dict[str, float] = ranking_agreement(examples, args.context, scorer, reference, args.batch_size,
+                                                        args.top_k if args.top_k is not None else 10)
+        print('[Done].')
+        for metric, value in agreement.items():
+            print('{}: {:.4f}'.format(metric, value) if isinstance(value, float) else '{}: {}'.format(metric, value))
+
+    index: Optional[EntityIndex] = None
+    if args.mode == 'retrieve':
+        index_path: str = args.index if args.index is not None else \
+            os.path.splitext(args.embeddings)[0] + '.' + args.index_type
+        print('Loading entity index...')
+        index = EntityIndex.load_or_build(index_path, store, scorer, args.index_type)
+        index.ef_search = args.ef_search
+        index.nprobe = args.nprobe
+        print('[Done].')
 
     print('Generating entity ranking...')
-    run_file_strings: List[str] = rank_entities(args.data, args.context, entity_embeddings)
-    print('[Done].')
-
-    print('Writing to file...')
-    write_to_file(run_file_strings, args.save)
+    output_file: str = sharding.run(
+        read_examples=lambda select: utils.aspect_link_examples(args.data, fields=fields, select=select),
+        process_chunk=lambda examples: rank_examples(
+            examples, args.context, scorer, args.batch_size, index, args.retrieve_k, args.query, args.top_k),
+        save=args.save,
+        shard=args.shard,
+        checkpoint_every=args.checkpoint_every,
+        resume=args.resume,
+        total=totals.get(os.path.basename(args.data))
+    )
     print('[Done].')
+    print('File written to ==> {}'.format(output_file))
 
 
 if __name__ == '__main__':
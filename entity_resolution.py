@@ -0,0 +1,84 @@
+"""
+Persistent CAR entity id -> embedding row mapping, shared by the E-BERT and Wikipedia2Vec converters.
+
+Resolving millions of CAR entity names against a Wikipedia2Vec vocabulary (name normalization plus a dictionary
+lookup per entity) is the same work on every converter run. The result depends only on the model and the id2name
+mapping, so it is saved once, next to the converter output, and reused:
+    1. <name>.rows.npy: int64 row of every entity in the model's matrix (-1 if the entity is not in the vocabulary).
+    2. <name>.ids: CAR entity id of every row of <name>.rows.npy, one per line.
+    3. <name>.json: signatures (absolute path, size, modification time) of the model and the id2name file it was
+       built from. A mapping is only reused if both still match, and it is written last.
+The mapping is memory-mapped on load, so it costs one int64 per entity regardless of the vocabulary size.
+"""
+
+import os
+import json
+import numpy as np
+from typing import List, Dict, Tuple, Optional, Callable
+from checkpoint import written_last
+
+# (known entity ids, their rows, unknown entity ids)
+Resolution = Tuple[List[str], np.ndarray, List[str]]
+
+
+def mapping_files(path: str) -> Tuple[str, str, str]:
+    return path + '.rows.npy', path + '.ids', path + '.json'
+
+
+def file_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def save_resolution(path: str, resolution: Resolution, model_file: str, id2name_file: str) -> None:
+    known, rows, unknown = resolution
+    rows_file, ids_file, meta_file = mapping_files(path)
+    meta = {'model': file_signature(model_file), 'id2name': file_signature(id2name_file)}
+    # The signatures in the metadata are what `load_resolution` checks before reusing the mapping.
+    with written_last(meta_file, meta):
+        np.save(rows_file, np.concatenate([np.asarray(rows, dtype=np.int64),
+                                           np.full(len(unknown), -1, dtype=np.int64)]))
+        with open(ids_file, 'w') as f:
+            for entity_id in known + unknown:
+                f.write("%s\n" % entity_id)
+
+
+def load_resolution(path: str, model_file: str, id2name_file: str) -> Optional[Resolution]:
+    """
+    The saved mapping at `path`, or None if there is none or it was built from a different model or id2name file.
+    """
+    rows_file, ids_file, meta_file = mapping_files(path)
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    if meta['model'] != file_signature(model_file) or meta['id2name'] != file_signature(id2name_file):
+        return None
+
+    rows = np.load(rows_file, mmap_mode='r')
+    with open(ids_file, 'r') as f:
+        entity_ids: List[str] = [line.rstrip('\n') for line in f]
+    num_known: int = int(np.count_nonzero(rows >= 0))
+    return entity_ids[:num_known], np.asarray(rows[:num_known]), entity_ids[num_known:]
+
+
+def cached_resolution(
+        path: str,
+        model_file: str,
+        id2name_file: str,
+        resolve: Callable[[], Resolution]
+) -> Resolution:
+    """
+    Loads the mapping at `path` if it is up to date; otherwise runs `resolve` and saves its result there.
+    """
+    resolution = load_resolution(path, model_file, id2name_file)
+    if resolution is not None:
+        print('Using entity resolution cache ==> {}'.format(path))
+        return resolution
+    resolution = resolve()
+    save_resolution(path, resolution, model_file, id2name_file)
+    return resolution
+
+
+def default_path(save_dir: str, model_file: str) -> str:
+    return os.path.join(save_dir, os.path.basename(model_file) + '.entity_rows')
@@ -0,0 +1,174 @@
+"""
+Evaluation of run files against qrels (e.g., the output of `make_qrel_file.py`): MAP, P@1, NDCG@k and MRR,
+per query and in aggregate.
+
+Runs and qrels are read with `trec_io` into columnar arrays, and every metric is computed for all queries at once:
+the entries of all queries are ranked with one `np.lexsort`, relevance labels are joined with one `np.searchsorted`,
+and per-query sums are taken with `np.bincount`. The conventions follow trec_eval:
+    - entries are ranked by descending score, ties by descending doc id (the rank column is ignored),
+    - gains are the relevance labels, and a document is relevant if its label is > 0,
+    - NDCG@k uses the discount 1 / log2(rank + 1),
+    - by default, the aggregate is the mean over the queries that are both in the run and in the qrels; with
+      `all_queries`, every query of the qrels counts, and queries missing from the run get 0 (as `trec_eval -c`).
+"""
+
+import sys
+import itertools
+import argparse
+import numpy as np
+from typing import List, Dict, Tuple
+import trec_io
+from trec_io import Run
+
+
+def doc_order(pool) -> np.ndarray:
+    """
+    Lexicographic rank of every string of a string pool.
+    """
+    strings: List[str] = list(pool)
+    ranks = np.empty(len(strings), dtype=np.int64)
+    ranks[np.argsort(np.asarray(strings, dtype=object), kind='stable')] = np.arange(len(strings))
+    return ranks
+
+
+def relevance_labels(run: Run, qrels: Run) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Qrel query number of every run query (-1 if not in the qrels) and relevance label of every run entry
+    (0 if not judged).
+    """
+    qrel_queries = np.fromiter((qrels.query_index.get(query_id, -1) for query_id in run.queries),
+                               dtype=np.int64, count=len(run))
+    qrel_docs: Dict[str, int] = {doc_id: i for i, doc_id in enumerate(qrels.doc_pool)}
+    doc_map = np.fromiter(map(qrel_docs.get, run.doc_pool, itertools.repeat(-1)), dtype=np.int64,
+                          count=len(run.doc_pool))
+
+    # Every (query, doc) judgment as one int64 key, sorted for a binary search.
+    num_docs: int = max(len(qrels.doc_pool), 1)
+    judged_queries = np.repeat(np.arange(len(qrels), dtype=np.int64), np.diff(qrels.offsets))
+    judged_keys = judged_queries * num_docs + np.asarray(qrels.docs, dtype=np.int64)
+    order = np.argsort(judged_keys, kind='stable')
+    judged_keys, judged_labels = judged_keys[order], np.asarray(qrels.scores, dtype=np.float64)[order]
+
+    entry_queries = np.repeat(qrel_queries, np.diff(run.offsets))
+    entry_docs = doc_map[np.asarray(run.docs)]
+    keys = entry_queries * num_docs + entry_docs
+    found = np.searchsorted(judged_keys, keys)
+    found = np.minimum(found, max(len(judged_keys) - 1, 0))
+    labels = np.zeros(len(keys), dtype=np.float64)
+    if len(judged_keys) > 0:
+        hit = (entry_queries >= 0) & (entry_docs >= 0) & (judged_keys[found] == keys)
+        labels[hit] = judged_labels[found[hit]]
+    return qrel_queries, labels
+
+
+def ranked_positions(group: np.ndarray, keys: Tuple[np.ndarray, ...], num_groups: int) -> Tuple[np.ndarray, ...]:
+    """
+    Sorts entries by group, then by `keys` (most significant last, as in `np.lexsort`).
+    :return: (order, 0-based position of every sorted entry within its group)
+    """
+    order = np.lexsort(keys + (group,))
+    counts = np.bincount(group, minlength=num_groups)
+    starts = np.zeros(num_groups, dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    positions = np.arange(len(order)) - np.repeat(starts, counts)
+    return order, positions
+
+
+def evaluate(run: Run, qrels: Run, ndcg_k: Tuple[int, ...] = (5, 10, 20),
+             all_queries: bool = False) -> Tuple[List[str], Dict[str, np.ndarray]]:
+    """
+    Computes MAP, P@1, MRR and NDCG@k for every evaluated query.
+    :return: (query ids, {metric: per-query values}), both in qrels order.
+    """
+    num_queries: int = len(qrels)
+    qrel_groups = np.repeat(np.arange(num_queries, dtype=np.int64), np.diff(qrels.offsets))
+    qrel_labels = np.asarray(qrels.scores, dtype=np.float64)
+    num_relevant = np.bincount(qrel_groups, weights=(qrel_labels > 0), minlength=num_queries)
+
+    # Rank the entries of all queries at once: by query, descending score, then descending doc id.
+    qrel_queries, labels = relevance_labels(run, qrels)
+    entry_groups = np.repeat(qrel_queries, np.diff(run.offsets))
+    judged = entry_groups >= 0
+    scores = np.asarray(run.scores, dtype=np.float64)[judged]
+    doc_ranks = doc_order(run.doc_pool)[np.asarray(run.docs)[judged]]
+    entry_groups, labels = entry_groups[judged], labels[judged]
+    order, positions = ranked_positions(entry_groups, (-doc_ranks, -scores), num_queries)
+    groups, gains = entry_groups[order], labels[order]
+    relevant = gains > 0
+    ranks = positions + 1
+
+    # Average precision: precision at every relevant rank, summed per query.
+    hits = np.cumsum(relevant)
+    hits_before = np.zeros(num_queries, dtype=np.int64)
+    first = positions == 0
+    hits_before[groups[first]] = hits[first] - relevant[first]
+    hits -= hits_before[groups]
+    precision_sum = np.bincount(groups, weights=np.where(relevant, hits / ranks, 0.0), minlength=num_queries)
+
+    # Reciprocal rank of the first relevant entry.
+    first_relevant = np.full(num_queries, np.inf)
+    np.minimum.at(first_relevant, groups[relevant], ranks[relevant])
+
+    metrics: Dict[str, np.ndarray] = {
+        'map': np.divide(precision_sum, num_relevant, out=np.zeros(num_queries), where=num_relevant > 0),
+        'P_1': np.bincount(groups, weights=(relevant & (ranks == 1)), minlength=num_queries),
+        'recip_rank': 1.0 / first_relevant,
+    }
+
+    # NDCG@k: the ideal ranking is the qrels of every query by descending label.
+    ideal_order, ideal_positions = ranked_positions(qrel_groups, (-qrel_labels,), num_queries)
+    ideal_groups, ideal_gains = qrel_groups[ideal_order], np.maximum(qrel_labels[ideal_order], 0)
+    for k in ndcg_k:
+        dcg = np.bincount(groups, weights=np.where(ranks <= k, gains / np.log2(ranks + 1), 0.0),
+                          minlength=num_queries)
+        ideal_dcg = np.where(ideal_positions < k, ideal_gains / np.log2(ideal_positions + 2), 0.0)
+        idcg = np.bincount(ideal_groups, weights=ideal_dcg, minlength=num_queries)
+        metrics['ndcg_cut_{}'.format(k)] = np.divide(dcg, idcg, out=np.zeros(num_queries), where=idcg > 0)
+
+    evaluated = np.ones(num_queries, dtype=bool)
+    if not all_queries:
+        evaluated[:] = False
+        evaluated[qrel_queries[qrel_queries >= 0]] = True
+    query_ids: List[str] = [query_id for query_id, keep in zip(qrels.queries, evaluated.tolist()) if keep]
+    return query_ids, {metric: values[evaluated] for metric, values in metrics.items()}
+
+
+def report_lines(query_ids: List[str], metrics: Dict[str, np.ndarray], per_query: bool = False) -> List[str]:
+    """
+    Results in the trec_eval format (metric \t query_id \t value); the aggregate has query id `all`.
+    """
+    lines: List[str] = []
+    for metric, values in metrics.items():
+        if per_query:
+            lines.extend('{}\t{}\t{:.4f}'.format(metric, query_id, value)
+                         for query_id, value in zip(query_ids, values.tolist()))
+        lines.append('{}\tall\t{:.4f}'.format(metric, values.mean() if len(values) else 0.0))
+    lines.append('num_q\tall\t{}'.format(len(query_ids)))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser("Evaluate a run file against a qrels file.")
+    parser.add_argument("--run", help="Run file (text or binary, see trec_io.py).", required=True, type=str)
+    parser.add_argument("--qrels", help="Qrels file.", required=True, type=str)
+    parser.add_argument("--ndcg-k", help="Cutoffs for NDCG. Default: 5 10 20.", nargs='+', default=[5, 10, 20],
+                        type=int)
+    parser.add_argument("--per-query", help="Also print the metrics of every query.", action='store_true')
+    parser.add_argument("--all-queries", help="Average over all queries of the qrels; queries missing from the "
+                                              "run count as 0 (as trec_eval -c).", action='store_true')
+    parser.add_argument("--save", help="Also write the results to this file.", default=None, type=str)
+    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+
+    run: Run = trec_io.read_run(args.run)
+    qrels: Run = trec_io.read_qrels(args.qrels)
+    query_ids, metrics = evaluate(run, qrels, tuple(args.ndcg_k), args.all_queries)
+    lines: List[str] = report_lines(query_ids, metrics, args.per_query)
+
+    for line in lines:
+        print(line)
+    if args.save is not None:
+        trec_io.write_lines(lines, args.save)
+
+
+if __name__ == '__main__':
+    main()
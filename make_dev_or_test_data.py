@@ -4,9 +4,13 @@ import sys
 from tqdm import tqdm
 import os
 import argparse
+import functools
+import multiprocessing
 import utils
+import sharding
 from typing import List, Dict, Set, Tuple, Any
 from object_models import Location, Entity, AnnotatedText, AspectLinkExample, Aspect, Context
+from description_table import DescriptionTable
 
 totals = {
     'nanni-test.jsonl.gz': 18289,
@@ -17,13 +21,20 @@ totals = {
     'validation.jsonl.gz': 4313,
     'nanni-201.modified.jsonl.gz': 143
 }
-processor = utils.TextProcessor()
+processor = utils.worker_processor()
+
+
+def select_entities(example: AspectLinkExample) -> Tuple[List[str], List[str]]:
+    pos_entities, neg_entities = utils.get_entities(example.candidate_aspects, example.true_aspect)
+    # Sorted, so that the output does not depend on the string hash seed of the process.
+    return sorted(pos_entities), sorted(neg_entities)
 
 
 def to_data(
         example: AspectLinkExample,
         context_type: str,
-        desc: Dict[str, Dict[str, str]],
+        desc: DescriptionTable,
+        desc_preprocessed: bool = False
 ) -> List[str]:
     data: List[str] = []
 
@@ -32,55 +43,98 @@ def to_data(
 
     if query_id in desc:
         query_desc_dict: Dict[str, str] = desc[query_id]
-        pos_entities, neg_entities = utils.get_entities(example.candidate_aspects, example.true_aspect)
-
-        pos_entities = list(pos_entities)
-        neg_entities = list(neg_entities)
+        pos_entities, neg_entities = select_entities(example)
+        query, docs = utils.preprocess_query_and_docs(
+            processor, query, query_desc_dict, pos_entities + neg_entities, desc_preprocessed)
 
         for entity_id in pos_entities:
-            if entity_id in query_desc_dict:
+            if entity_id in docs:
                 data.append(json.dumps({
                     'query_id': query_id,
-                    'query': processor.preprocess(query),
+                    'query': query,
                     'doc_id': entity_id,
-                    'doc': processor.preprocess(query_desc_dict[entity_id]),
+                    'doc': docs[entity_id],
                     'label': 1,
                 }))
 
         for entity_id in neg_entities:
-            if entity_id in query_desc_dict:
+            if entity_id in docs:
                 data.append(json.dumps({
                     'query_id': query_id,
-                    'query': processor.preprocess(query),
+                    'query': query,
                     'doc_id': entity_id,
-                    'doc': processor.preprocess(query_desc_dict[entity_id]),
+                    'doc': docs[entity_id],
                     'label': 0,
                 }))
 
     return data
 
 
+def to_texts(
+        example: AspectLinkExample,
+        context_type: str,
+        desc: DescriptionTable,
+        desc_preprocessed: bool = False
+) -> List[str]:
+    """
+    The texts `to_data` preprocesses for the same arguments, batched per chunk by `utils.preprocess_chunk`.
+    """
+    if example.id not in desc:
+        return []
+    pos_entities, neg_entities = select_entities(example)
+    query: str = example.context.sentence.content if context_type == 'sent' else example.context.paragraph.content
+    return utils.texts_to_preprocess(query, desc[example.id], pos_entities + neg_entities, desc_preprocessed)
+
+
 def create_data(
         data_file: str,
         save: str,
         context_type: str,
-        desc_dict: Dict[str, Dict[str, str]],
-        num_workers: int
+        desc_dict: DescriptionTable,
+        num_workers: int,
+        desc_preprocessed: bool = False,
+        chunk_size: int = 16,
+        preprocess_cache: str = None,
+        shard: str = None,
+        checkpoint_every: int = 10000,
+        resume: bool = False
 ) -> None:
+    """
+    Examples are processed in chunks of `chunk_size` by a pool of `num_workers` processes.
+    Results are written in input order as soon as they are ready, so the output is the same as a serial run.
+    Output is committed every `checkpoint_every` examples (see `sharding.py`).
+    """
     print('Context type: {}'.format(context_type))
     print('Number of processes = {}'.format(num_workers))
     total = totals[os.path.basename(data_file)]
+    fields = {'id', 'true_aspect', 'sentence' if context_type == 'sent' else 'paragraph', 'aspects'}
+
+    with multiprocessing.Pool(num_workers, initializer=utils.init_worker, initargs=(preprocess_cache,)) as pool:
+
+        def to_lines(examples):
+            results = utils.ordered_imap(
+                pool,
+                to_data,
+                utils.worker_payloads(examples, context_type, desc_dict, desc_preprocessed),
+                max_pending=2 * num_workers,
+                chunk_size=chunk_size,
+                # spaCy runs inside the pool workers, which cannot start processes of their own.
+                call_chunk=functools.partial(utils.preprocess_chunk, texts=to_texts, n_process=1)
+            )
+            return (line for data in results for line in data)
+
+        output_file = sharding.run(
+            read_examples=lambda select: utils.aspect_link_examples(data_file, fields=fields, select=select),
+            process_chunk=to_lines,
+            save=save,
+            shard=shard,
+            checkpoint_every=checkpoint_every,
+            resume=resume,
+            total=total
+        )
 
-    data = []
-
-    for example in tqdm(utils.aspect_link_examples(data_file), total=total):
-        data.append(to_data(example, context_type, desc_dict))
-
-    print('Writing to file...')
-    for d in data:
-        utils.write_to_file(d, save)
     print('[Done].')
-    print('File written to ==> {}'.format(save))
+    print('File written to ==> {}'.format(output_file))
 
 
 def main():
@@ -88,13 +142,17 @@ def main():
     parser.add_argument("--data", help="Data file.", required=True, type=str)
     parser.add_argument("--save", help="Output file.", required=True, type=str)
     parser.add_argument("--context", help="Type of context to use (sent|para)", required=True, type=str)
-    parser.add_argument("--desc", help='File containing entity description.', required=True, type=str)
+    parser.add_argument("--desc", help='File containing entity description (or a preprocessed description store).',
+                        required=True, type=str)
     parser.add_argument("--num-workers", help="Number of processes to use. Default: 4.",
                         default=4, type=int)
+    parser.add_argument("--preprocess-cache", help="LMDB directory caching preprocessed texts across runs.",
+                        default=None, type=str)
+    sharding.add_arguments(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
 
     print('Reading description file....')
-    desc_dict: Dict[str, Dict[str, str]] = utils.read_entity_data_file(args.desc)
+    desc_dict, desc_preprocessed = utils.load_entity_data(args.desc)
     print('[Done].')
 
     create_data(
@@ -102,7 +160,12 @@ def main():
         save=args.save,
         context_type=args.context,
         desc_dict=desc_dict,
-        num_workers=args.num_workers
+        num_workers=args.num_workers,
+        desc_preprocessed=desc_preprocessed,
+        preprocess_cache=args.preprocess_cache,
+        shard=args.shard,
+        checkpoint_every=args.checkpoint_every,
+        resume=args.resume
     )
 
 
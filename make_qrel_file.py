@@ -6,6 +6,8 @@ from tqdm import tqdm
 import os
 import argparse
 import utils
+import sharding
+import trec_io
 from joblib import Parallel, delayed
 from typing import List, Dict, Set, Tuple, Any
 from object_models import Location, Entity, AnnotatedText, AspectLinkExample, Aspect, Context
@@ -30,36 +32,43 @@ def get_entities(candidate_aspects: List[Aspect], true_aspect: str) -> Tuple[Set
             neg_entities.extend(utils.get_entity_ids_only(aspect.aspect_content.entities))
     return pos_entities, set(neg_entities)
 
-def create_qrels(data, save):
-    run_strings = []
+def create_qrels(data, save, shard=None, checkpoint_every=10000, resume=False):
     total = totals[os.path.basename(data)]
-    for example in tqdm(utils.aspect_link_examples(data), total=total):
-        query_id: str = example.id
-        pos_entities, neg_entities = get_entities(example.candidate_aspects, example.true_aspect)
-        pos_entities = set(pos_entities)
-        for entity_id in pos_entities:
-            if entity_id:
-                run_string = query_id + ' Q0 ' + entity_id + ' 1'
-                run_strings.append(run_string)
-
-    print('Writing to file...')
-    write_to_file(run_strings, save)
-    print('[Done].')
 
+    def to_lines(examples):
+        run_strings = []
+        for example in examples:
+            query_id: str = example.id
+            pos_entities, neg_entities = get_entities(example.candidate_aspects, example.true_aspect)
+            pos_entities = set(pos_entities)
+            for entity_id in pos_entities:
+                if entity_id:
+                    run_strings.append(trec_io.qrel_line(query_id, entity_id))
+        return run_strings
 
-def write_to_file(data: List[str], output_file: str):
-    with open(output_file, 'a') as f:
-        for line in data:
-            f.write("%s\n" % line)
+    output_file = sharding.run(
+        read_examples=lambda select: utils.aspect_link_examples(data, fields={'id', 'true_aspect', 'aspects'},
+                                                                select=select),
+        process_chunk=to_lines,
+        save=save,
+        shard=shard,
+        checkpoint_every=checkpoint_every,
+        resume=resume,
+        total=total
+    )
+    print('[Done].')
+    print('File written to ==> {}'.format(output_file))
 
 
 def main():
     parser = argparse.ArgumentParser("Create a qrels file.")
     parser.add_argument("--data", help="Data file.", required=True, type=str)
     parser.add_argument("--save", help="Output file.", required=True, type=str)
+    sharding.add_arguments(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
 
-    create_qrels(data=args.data, save=args.save)
+    create_qrels(data=args.data, save=args.save, shard=args.shard, checkpoint_every=args.checkpoint_every,
+                 resume=args.resume)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
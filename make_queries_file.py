@@ -6,6 +6,8 @@ from tqdm import tqdm
 import os
 import argparse
 import utils
+import sharding
+from checkpoint import read_checkpoint
 from joblib import Parallel, delayed
 from typing import List, Dict, Set, Tuple, Any
 from object_models import Location, Entity, AnnotatedText, AspectLinkExample, Aspect, Context
@@ -20,33 +22,69 @@ totals = {
     'nanni-201.modified.jsonl.gz': 143
 }
 
-def create_queries(data, context_type, save):
-    d = {}
-    total = totals[os.path.basename(data)]
-    for example in tqdm(utils.aspect_link_examples(data),total=total):
-        query_id = example.id
-        query = example.context.sentence.content if context_type == 'sent' else example.context.paragraph.content
-        d[query_id] = query
+def committed_query_ids(output_file: str) -> Set[str]:
+    """
+    Query ids in the committed part of an output file (see `sharding.py`), i.e., the part a resumed run keeps.
+    """
+    checkpoint = read_checkpoint(output_file)
+    query_ids: Set[str] = set()
+    if checkpoint is None:
+        return query_ids
+    size = 0
+    with open(output_file, 'rb') as f:
+        for line in f:
+            size += len(line)
+            if size > checkpoint['size']:
+                break
+            query_ids.add(line.decode('UTF-8').split('\t', 1)[0])
+    return query_ids
 
-    print('Writing to file...')
-    write_to_file(d, save)
-    print('[Done].')
 
+def create_queries(data, context_type, save, shard=None, checkpoint_every=10000, resume=False):
+    """
+    Every query id is written once, with the query of its first occurrence (earlier versions kept the last one, which
+    cannot be done once the chunk with the first occurrence is committed). Ids are deduplicated across the chunks of
+    a run (and of the runs it resumes), but not across shards: an id in chunks of two shards is written by both.
+    """
+    total = totals[os.path.basename(data)]
+    fields = {'id', 'sentence' if context_type == 'sent' else 'paragraph'}
+    seen: Set[str] = committed_query_ids(sharding.shard_output(save, shard)) if resume else set()
 
-def write_to_file(data, save):
-    with open(save, 'a') as f:
-        for query_id, query in data.items():
-            f.write("%s\t%s\n" % (query_id, query))
+    def to_lines(examples):
+        lines = []
+        for example in examples:
+            query_id = example.id
+            if query_id in seen:
+                continue
+            seen.add(query_id)
+            query = example.context.sentence.content if context_type == 'sent' else example.context.paragraph.content
+            lines.append("%s\t%s" % (query_id, query))
+        return lines
+
+    output_file = sharding.run(
+        read_examples=lambda select: utils.aspect_link_examples(data, fields=fields, select=select),
+        process_chunk=to_lines,
+        save=save,
+        shard=shard,
+        checkpoint_every=checkpoint_every,
+        resume=resume,
+        total=total
+    )
+    print('[Done].')
+    print('File written to ==> {}'.format(output_file))
 
 
 def main():
     parser = argparse.ArgumentParser("Create a queries file.")
     parser.add_argument("--data", help="Data file.", required=True, type=str)
     parser.add_argument("--context", help="Context type (sent|para).", required=True, type=str)
-    parser.add_argument("--save", help="Output file.", required=True, type=str)
+    parser.add_argument("--save", help="Output file. A query id that occurs more than once is written once, with "
+                                       "the query of its first occurrence.", required=True, type=str)
+    sharding.add_arguments(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
 
-    create_queries(data=args.data, context_type=args.context, save=args.save)
+    create_queries(data=args.data, context_type=args.context, save=args.save, shard=args.shard,
+                   checkpoint_every=args.checkpoint_every, resume=args.resume)
 
 if __name__ == '__main__':
     main()
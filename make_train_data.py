@@ -5,10 +5,14 @@ from utils import tqdm_joblib
 from tqdm import tqdm
 import os
 import argparse
+import functools
+import multiprocessing
 import utils
+import sharding
 from joblib import Parallel, delayed
 from typing import List, Dict, Set, Tuple, Any
 from object_models import Location, Entity, AnnotatedText, AspectLinkExample, Aspect, Context
+from description_table import DescriptionTable
 
 totals = {
     'nanni-test.jsonl.gz': 18289,
@@ -18,39 +22,42 @@ totals = {
     'train-small.jsonl.gz': 5498,
     'validation.jsonl.gz': 4313
 }
-processor = utils.TextProcessor()
+processor = utils.worker_processor()
+
+
+def select_entities(example: AspectLinkExample) -> Tuple[List[str], List[str]]:
+    pos_entities, neg_entities = utils.get_entities(example.candidate_aspects, example.true_aspect)
+    k = min(len(pos_entities), len(neg_entities))
+    return list(pos_entities)[:k], list(neg_entities)[:k]
 
 
 def to_pairwise_data(
         example: AspectLinkExample,
         context_type: str,
-        desc: Dict[str, Dict[str, str]],
+        desc: DescriptionTable,
+        desc_preprocessed: bool = False
 ) -> List[str]:
     data: List[str] = []
 
     query_id: str = example.id
-    query: str = processor.preprocess(
-        example.context.sentence.content) if context_type == 'sent' else processor.preprocess(
-        example.context.paragraph.content)
+    query: str = example.context.sentence.content if context_type == 'sent' else example.context.paragraph.content
 
     if query_id in desc:
 
         query_desc_dict: Dict[str, str] = desc[query_id]
-        pos_entities, neg_entities = utils.get_entities(example.candidate_aspects, example.true_aspect)
-
-        k = min(len(pos_entities), len(neg_entities))
-        pos_entities = list(pos_entities)[:k]
-        neg_entities = list(neg_entities)[:k]
+        pos_entities, neg_entities = select_entities(example)
 
         entity_pairs: List[List[str]] = [[a, b] for a in pos_entities for b in neg_entities if a != b]
+        query, docs = utils.preprocess_query_and_docs(
+            processor, query, query_desc_dict, pos_entities + neg_entities, desc_preprocessed)
 
         for pos_entity, neg_entity in entity_pairs:
-            if pos_entity in query_desc_dict and neg_entity in query_desc_dict:
+            if pos_entity in docs and neg_entity in docs:
                 data.append(json.dumps({
                     'query_id': query_id,
                     'query': query,
-                    'doc_pos': processor.preprocess(query_desc_dict[pos_entity]),
-                    'doc_neg': processor.preprocess(query_desc_dict[neg_entity])
+                    'doc_pos': docs[pos_entity],
+                    'doc_neg': docs[neg_entity]
                 }))
 
     return data
@@ -59,75 +66,121 @@ def to_pairwise_data(
 def to_pointwise_data(
         example: AspectLinkExample,
         context_type: str,
-        desc: Dict[str, Dict[str, str]],
+        desc: DescriptionTable,
+        desc_preprocessed: bool = False
 ) -> List[str]:
     data: List[str] = []
 
     query_id: str = example.id
-    query: str = processor.preprocess(
-        example.context.sentence.content) if context_type == 'sent' else processor.preprocess(
-        example.context.paragraph.content)
+    query: str = example.context.sentence.content if context_type == 'sent' else example.context.paragraph.content
 
     if query_id in desc:
         query_desc_dict: Dict[str, str] = desc[query_id]
-        pos_entities, neg_entities = utils.get_entities(example.candidate_aspects, example.true_aspect)
-
-        k = min(len(pos_entities), len(neg_entities))
-        pos_entities = list(pos_entities)[:k]
-        neg_entities = list(neg_entities)[:k]
+        pos_entities, neg_entities = select_entities(example)
+        query, docs = utils.preprocess_query_and_docs(
+            processor, query, query_desc_dict, pos_entities + neg_entities, desc_preprocessed)
 
         for entity_id in pos_entities:
-            if entity_id in query_desc_dict:
+            if entity_id in docs:
                 data.append(json.dumps({
                     'query_id': query_id,
                     'query': query,
-                    'doc': processor.preprocess(query_desc_dict[entity_id]),
+                    'doc': docs[entity_id],
                     'label': 1,
                 }))
 
         for entity_id in neg_entities:
-            if entity_id in query_desc_dict:
+            if entity_id in docs:
                 data.append(json.dumps({
                     'query_id': query_id,
                     'query': query,
-                    'doc': processor.preprocess(query_desc_dict[entity_id]),
+                    'doc': docs[entity_id],
                     'label': 0,
                 }))
 
     return data
 
 
+def to_texts(
+        example: AspectLinkExample,
+        context_type: str,
+        desc: DescriptionTable,
+        desc_preprocessed: bool = False
+) -> List[str]:
+    """
+    The texts `to_pairwise_data`/`to_pointwise_data` preprocess for the same arguments, batched per chunk by
+    `utils.preprocess_chunk`.
+    """
+    if example.id not in desc:
+        return []
+    pos_entities, neg_entities = select_entities(example)
+    query: str = example.context.sentence.content if context_type == 'sent' else example.context.paragraph.content
+    return utils.texts_to_preprocess(query, desc[example.id], pos_entities + neg_entities, desc_preprocessed)
+
+
 def create_data(
         data_type: str,
         data_file: str,
         save: str,
         context_type: str,
-        desc_dict: Dict[str, Dict[str, str]],
-        num_workers: int
+        desc_dict: DescriptionTable,
+        num_workers: int,
+        desc_preprocessed: bool = False,
+        parse_workers: int = 1,
+        compression: str = None,
+        chunk_size: int = 16,
+        preprocess_cache: str = None,
+        shard: str = None,
+        checkpoint_every: int = 10000,
+        resume: bool = False
 ) -> None:
+    """
+    Results are written as soon as they are ready (in input order) by a single buffered writer,
+    so memory stays bounded regardless of the size of the output.
+    The description table stays in this process; workers only receive the descriptions of each example's query.
+    Output is committed every `checkpoint_every` examples (see `sharding.py`).
+    """
     print('Data type: {}'.format(data_type))
     print('Context type: {}'.format(context_type))
     print('Number of processes = {}'.format(num_workers))
     total = totals[os.path.basename(data_file)]
+    fields = {'id', 'true_aspect', 'sentence' if context_type == 'sent' else 'paragraph', 'aspects'}
 
     if data_type == 'pairwise':
-        with tqdm_joblib(tqdm(desc="Progress", total=total)) as progress_bar:
-            data = Parallel(n_jobs=num_workers, backend='multiprocessing')(
-                delayed(to_pairwise_data)(example, context_type, desc_dict)
-                for example in utils.aspect_link_examples(data_file))
+        to_data = to_pairwise_data
     elif data_type == 'pointwise':
-        with tqdm_joblib(tqdm(desc="Progress", total=total)) as progress_bar:
-            data = Parallel(n_jobs=num_workers, backend='multiprocessing')(
-                delayed(to_pointwise_data)(example, context_type, desc_dict)
-                for example in utils.aspect_link_examples(data_file))
+        to_data = to_pointwise_data
     else:
         raise ValueError('Mode must be `pairwise` or `pointwise`.')
 
-    print('Writing to file...')
-    for d in data:
-        utils.write_to_file(d, save)
+    with multiprocessing.Pool(num_workers, initializer=utils.init_worker, initargs=(preprocess_cache,)) as pool:
+
+        def to_lines(examples):
+            results = utils.ordered_imap(
+                pool,
+                to_data,
+                utils.worker_payloads(examples, context_type, desc_dict, desc_preprocessed),
+                max_pending=2 * num_workers,
+                chunk_size=chunk_size,
+                # spaCy runs inside the pool workers, which cannot start processes of their own.
+                call_chunk=functools.partial(utils.preprocess_chunk, texts=to_texts, n_process=1)
+            )
+            return (line for data in results for line in data)
+
+        output_file = sharding.run(
+            read_examples=lambda select: utils.aspect_link_examples(
+                data_file, fields=fields, num_workers=parse_workers, select=select),
+            process_chunk=to_lines,
+            save=save,
+            shard=shard,
+            checkpoint_every=checkpoint_every,
+            resume=resume,
+            compression=compression,
+            total=total
+        )
+
     print('[Done].')
-    print('File written to ==> {}'.format(save))
+    print('File written to ==> {}'.format(output_file))
 
 
 def main():
@@ -137,9 +190,17 @@ def main():
     parser.add_argument("--save", help="Output directory.", required=True, type=str)
     parser.add_argument("--context", help="Type of context to use (sent|para). Default: paragraph context.",
                         required=True, type=str)
-    parser.add_argument("--desc", help='File containing entity description.', required=True, type=str)
+    parser.add_argument("--desc", help='File containing entity description (or a preprocessed description store).',
+                        required=True, type=str)
     parser.add_argument("--num-workers", help="Number of processes to use. Default: 4.",
                         default=4, type=int)
+    parser.add_argument("--preprocess-cache", help="LMDB directory caching preprocessed texts across runs.",
+                        default=None, type=str)
+    parser.add_argument("--parse-workers", help="Number of processes used to read the data file. Default: 1.",
+                        default=1, type=int)
+    parser.add_argument("--compress", help="Compress the output file (gzip|zstd). Default: no compression.",
+                        default=None, choices=['gzip', 'zstd'])
+    sharding.add_arguments(parser)
     args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
 
     if args.mode == 'pairwise':
@@ -150,10 +211,12 @@ def main():
         raise ValueError('Task must be `pairwise` or `pointwise`.')
 
     print('Reading description file....')
-    desc_dict: Dict[str, Dict[str, str]] = utils.read_entity_data_file(args.desc)
+    desc_dict, desc_preprocessed = utils.load_entity_data(args.desc)
     print('[Done].')
 
     save: str = args.save + '/' + 'train.' + args.mode + '.jsonl'
+    if args.compress is not None:
+        save += '.gz' if args.compress == 'gzip' else '.zst'
 
     create_data(
         data_type=args.mode,
@@ -161,7 +224,14 @@ def main():
         save=save,
         context_type=args.context,
         desc_dict=desc_dict,
-        num_workers=args.num_workers
+        num_workers=args.num_workers,
+        desc_preprocessed=desc_preprocessed,
+        parse_workers=args.parse_workers,
+        compression=args.compress,
+        preprocess_cache=args.preprocess_cache,
+        shard=args.shard,
+        checkpoint_every=args.checkpoint_every,
+        resume=args.resume
     )
 
 
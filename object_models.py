@@ -100,3 +100,123 @@ class AspectLinkExample(JsonObject):
                '    true_aspect: {},\n' \
                '    candidate_aspects: {}\n' \
                ')'.format(self.unhashed_id, self.id, self.context, self.true_aspect, self.candidate_aspects)
+
+
+# Lightweight, __slots__-based counterparts of the models above.
+# They expose the same attributes as the Pykson models, but are built directly from parsed JSON
+# (or from the dataset cache) without any validation. Fields that were not loaded are None.
+
+class LocationRecord:
+    __slots__ = ('location_id', 'page_id', 'page_title', 'paragraph_id', 'section_id', 'section_headings')
+
+    def __init__(self, location_id=None, page_id=None, page_title=None, paragraph_id=None, section_id=None,
+                 section_headings=None):
+        self.location_id = location_id
+        self.page_id = page_id
+        self.page_title = page_title
+        self.paragraph_id = paragraph_id
+        self.section_id = section_id
+        self.section_headings = section_headings
+
+    def __repr__(self):
+        return 'LocationRecord (\n ' \
+               '    location_id: {},\n ' \
+               '    page_id: {}, \n' \
+               '    page_title: {},\n ' \
+               '    paragraph_id: {},\n ' \
+               '    section_id: {}, \n ' \
+               '    section_headings: {}\n' \
+               ')'.format(self.location_id, self.page_id, self.page_title, self.paragraph_id, self.section_id,
+                          self.section_headings)
+
+
+class EntityRecord:
+    __slots__ = ('entity_name', 'entity_id', 'mention', 'target_mention', 'start', 'end')
+
+    def __init__(self, entity_id=None, entity_name=None, mention=None, target_mention=None, start=None, end=None):
+        self.entity_name = entity_name
+        self.entity_id = entity_id
+        self.mention = mention
+        self.target_mention = target_mention
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return 'EntityRecord (\n' \
+               '    name: {},\n' \
+               '    id: {}, \n' \
+               '    mention: {}, \n' \
+               '    target_mention: {},\n' \
+               '    start: {},\n' \
+               '    end: {},\n' \
+               ')'.format(self.entity_name, self.entity_id, self.mention, self.target_mention, self.start, self.end)
+
+
+class AnnotatedTextRecord:
+    __slots__ = ('content', 'entities')
+
+    def __init__(self, content=None, entities=None):
+        self.content = content
+        self.entities = entities if entities is not None else []
+
+    def __repr__(self):
+        return 'AnnotatedTextRecord (\n' \
+               '    content: {},\n' \
+               '    entities: {}\n' \
+               ')'.format(self.content, self.entities)
+
+
+class ContextRecord:
+    __slots__ = ('target_entity', 'location', 'sentence', 'paragraph')
+
+    def __init__(self, target_entity=None, location=None, sentence=None, paragraph=None):
+        self.target_entity = target_entity
+        self.location = location
+        self.sentence = sentence
+        self.paragraph = paragraph
+
+    def __repr__(self):
+        return 'ContextRecord (\n' \
+               '    target_entity: {},\n' \
+               '    location: {},\n' \
+               '    sentence: {},\n' \
+               '    paragraph: {},\n' \
+               ')'.format(self.target_entity, self.location, self.sentence, self.paragraph)
+
+
+class AspectRecord:
+    __slots__ = ('aspect_id', 'aspect_name', 'location', 'aspect_content')
+
+    def __init__(self, aspect_id=None, aspect_name=None, location=None, aspect_content=None):
+        self.aspect_id = aspect_id
+        self.aspect_name = aspect_name
+        self.location = location
+        self.aspect_content = aspect_content
+
+    def __repr__(self):
+        return 'AspectRecord (\n' \
+               '    aspect_id: {},\n' \
+               '    location: {},\n' \
+               '    content: {},\n' \
+               '    name: {},\n' \
+               ')'.format(self.aspect_id, self.location, self.aspect_content, self.aspect_name)
+
+
+class AspectLinkRecord:
+    __slots__ = ('unhashed_id', 'id', 'context', 'true_aspect', 'candidate_aspects')
+
+    def __init__(self, id=None, unhashed_id=None, context=None, true_aspect=None, candidate_aspects=None):
+        self.unhashed_id = unhashed_id
+        self.id = id
+        self.context = context
+        self.true_aspect = true_aspect
+        self.candidate_aspects = candidate_aspects if candidate_aspects is not None else []
+
+    def __repr__(self):
+        return 'AspectLinkRecord (\n' \
+               '    unhashed_id: {},\n' \
+               '    hashed_id: {},\n' \
+               '    context: {},\n' \
+               '    true_aspect: {},\n' \
+               '    candidate_aspects: {}\n' \
+               ')'.format(self.unhashed_id, self.id, self.context, self.true_aspect, self.candidate_aspects)
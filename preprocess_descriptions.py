@@ -0,0 +1,74 @@
+import os
+import sys
+import argparse
+import utils
+from checkpoint import written_last
+from tqdm import tqdm
+from typing import List, Dict
+
+
+def read_unique_descriptions(desc_file: str, index_file: str) -> List[str]:
+    """
+    Reads the description file (query_id \t entity_id \t description) and writes the index
+    (query_id \t entity_id \t row) of every description in the list of unique descriptions.
+    :return: The unique descriptions, in order of first occurrence.
+    """
+    rows: Dict[str, int] = {}
+    with open(desc_file, 'r') as file, open(index_file, 'w') as index:
+        for line in tqdm(file, desc='Reading descriptions'):
+            line_parts = line.split("\t")
+            if len(line_parts) == 3:
+                doc: str = line_parts[2]
+                if doc not in rows:
+                    rows[doc] = len(rows)
+                index.write("%s\t%s\t%d\n" % (line_parts[0], line_parts[1], rows[doc]))
+    return list(rows.keys())
+
+
+def preprocess_descriptions(
+        docs: List[str],
+        texts_file: str,
+        processor: utils.TextProcessor,
+        num_workers: int,
+        chunk_size: int
+) -> None:
+    with open(texts_file, 'w') as f:
+        for chunk in tqdm(utils.chunked(docs, chunk_size), desc='Preprocessing', total=-(-len(docs) // chunk_size)):
+            for text in processor.preprocess_batch(chunk, n_process=num_workers):
+                f.write("%s\n" % text)
+
+
+def main():
+    parser = argparse.ArgumentParser("Preprocess every unique entity description once.")
+    parser.add_argument("--desc", help='File containing entity description.', required=True, type=str)
+    parser.add_argument("--save", help="Output directory (preprocessed description store).", required=True, type=str)
+    parser.add_argument("--num-workers", help="Number of processes to use. Default: 4.", default=4, type=int)
+    parser.add_argument("--chunk-size", help="Number of descriptions per batch. Default: 50000.",
+                        default=50000, type=int)
+    parser.add_argument("--preprocess-cache", help="LMDB directory caching preprocessed texts across runs.",
+                        default=None, type=str)
+    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+
+    os.makedirs(args.save, exist_ok=True)
+    # Every description is unique here, so an in-process cache would only cost memory.
+    cache = utils.PreprocessingCache(path=args.preprocess_cache, max_size=0) if args.preprocess_cache else None
+    processor = utils.TextProcessor()
+    processor.cache = cache
+
+    meta: Dict[str, str] = {'desc': os.path.abspath(args.desc)}
+    # `DescriptionTable.from_store` only reads a store with a store.json, so a store being (re)written is not used.
+    with written_last(os.path.join(args.save, 'store.json'), meta):
+        print('Reading description file....')
+        docs: List[str] = read_unique_descriptions(args.desc, os.path.join(args.save, 'index.tsv'))
+        print('[Done].')
+        print('Number of unique descriptions = {}'.format(len(docs)))
+
+        print('Preprocessing descriptions...')
+        preprocess_descriptions(docs, os.path.join(args.save, 'texts.txt'), processor, args.num_workers,
+                                args.chunk_size)
+        print('[Done].')
+    print('Store written to ==> {}'.format(args.save))
+
+
+if __name__ == '__main__':
+    main()
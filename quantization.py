@@ -0,0 +1,245 @@
+"""
+Quantized embedding tables, to keep the embedding store of millions of CAR entities in RAM on the ranking nodes.
+
+Methods (bytes per entity for a table of dimension d):
+    - float16: the vectors as float16 (2d).
+    - int8: every row scaled by its largest absolute value into [-127, 127] (d, plus a float32 scale).
+    - pq: product quantization. The unit-length vectors are split into m sub-vectors, and every sub-vector is replaced
+      by the number of its nearest centroid among 256 learned by k-means (m, plus the shared codebook). Only the
+      directions are kept, which is all the cosine scores need.
+
+A quantized table is stored like a float32 one (see `embedding_store.py`): <name>.npy holds the codes, and int8 and pq
+add a side file (<name>.scales.npy or <name>.codebook.npy). The int8 and pq tables are loaded as `Int8Table` and
+`PQTable`, which decode only the rows they are indexed with, so `EntityScorer` scores directly on the (memory-mapped)
+codes and the full-precision table is never built.
+"""
+
+import os
+import numpy as np
+from tqdm import tqdm
+from typing import List, Tuple, Optional
+
+METHODS = ('float16', 'int8', 'pq')
+
+
+def side_files(vectors_file: str) -> Tuple[str, str]:
+    """
+    Returns the (int8 scales, pq codebook) file names of the table in `vectors_file`.
+    """
+    path = vectors_file[:-len('.npy')]
+    return path + '.scales.npy', path + '.codebook.npy'
+
+
+def remove_side_files(vectors_file: str) -> None:
+    # Left over from an earlier table at the same path, they would change how the new table is loaded.
+    for side_file in side_files(vectors_file):
+        if os.path.exists(side_file):
+            os.remove(side_file)
+
+
+class Int8Table:
+    def __init__(self, codes: np.ndarray, scales: np.ndarray):
+        """
+        :param codes: int8 matrix of shape (num_entities, dim).
+        :param scales: float32 scale of every row: a row is `codes[row] * scales[row]`.
+        """
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.codes.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, key) -> np.ndarray:
+        return np.asarray(self.codes[key], dtype=np.float32) * np.asarray(self.scales[key], dtype=np.float32)[..., None]
+
+
+class PQTable:
+    def __init__(self, codes: np.ndarray, codebook: np.ndarray):
+        """
+        :param codes: uint8 matrix of shape (num_entities, m): the centroid of every sub-vector.
+        :param codebook: float32 array of shape (m, num_centroids, dim / m).
+        """
+        self.codes = codes
+        self.codebook = codebook
+        self.subspaces = np.arange(codebook.shape[0])
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.codes.shape[0], self.codebook.shape[0] * self.codebook.shape[2]
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.codebook.nbytes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, key) -> np.ndarray:
+        codes = np.asarray(self.codes[key])
+        return self.codebook[self.subspaces, codes].reshape(codes.shape[:-1] + (-1,))
+
+
+def method(matrix) -> str:
+    """
+    Quantization method of a loaded table (`float32` for a full-precision one).
+    """
+    if isinstance(matrix, Int8Table):
+        return 'int8'
+    if isinstance(matrix, PQTable):
+        return 'pq'
+    return str(matrix.dtype)
+
+
+def load_matrix(vectors_file: str, mmap: bool = True):
+    """
+    Loads a float32 or float16 matrix as an array, and an int8 or pq table as an `Int8Table` or `PQTable`.
+    """
+    mmap_mode = 'r' if mmap else None
+    codes = np.load(vectors_file, mmap_mode=mmap_mode)
+    scales_file, codebook_file = side_files(vectors_file)
+    if os.path.exists(scales_file):
+        return Int8Table(codes, np.load(scales_file))
+    if os.path.exists(codebook_file):
+        return PQTable(codes, np.load(codebook_file))
+    return codes
+
+
+def unit_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def int8_codes(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Per-row scaled int8 codes of a float matrix. Zero rows get a scale of 0.
+    :return: (codes, scales)
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scaled = np.divide(vectors, scales[:, None], out=np.zeros_like(vectors), where=scales[:, None] > 0)
+    return np.clip(np.rint(scaled), -127, 127).astype(np.int8), scales.astype(np.float32)
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin |x - c|^2 = argmin |c|^2 - 2 x.c
+    distances = (centroids ** 2).sum(axis=1) - 2 * vectors @ centroids.T
+    return distances.argmin(axis=1)
+
+
+def train_codebook(
+        sample: np.ndarray,
+        num_subspaces: int,
+        num_centroids: int = 256,
+        iterations: int = 20,
+        seed: int = 0
+) -> np.ndarray:
+    """
+    Learns the pq codebook with k-means in every subspace.
+    :param sample: Unit-length vectors to train on.
+    :return: float32 array of shape (num_subspaces, num_centroids, dim / num_subspaces).
+    """
+    num_vectors, dim = sample.shape
+    if dim % num_subspaces != 0:
+        raise ValueError('Dimension ({}) must be a multiple of the number of subspaces ({}).'.format(
+            dim, num_subspaces))
+    num_centroids = min(num_centroids, 256, num_vectors)
+    random = np.random.RandomState(seed)
+    codebook = np.zeros((num_subspaces, num_centroids, dim // num_subspaces), dtype=np.float32)
+    for j, subvectors in enumerate(tqdm(np.split(sample, num_subspaces, axis=1), desc='Training codebook')):
+        centroids = subvectors[random.choice(num_vectors, num_centroids, replace=False)]
+        for _ in range(iterations):
+            assignment = nearest_centroids(subvectors, centroids)
+            counts = np.bincount(assignment, minlength=num_centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, subvectors)
+            # Empty clusters keep their centroid.
+            centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+        codebook[j] = centroids
+    return codebook
+
+
+def pq_codes(vectors: np.ndarray, codebook: np.ndarray) -> np.ndarray:
+    """
+    pq codes of the unit-length `vectors`.
+    """
+    codes = np.empty((len(vectors), codebook.shape[0]), dtype=np.uint8)
+    for j, subvectors in enumerate(np.split(vectors, codebook.shape[0], axis=1)):
+        codes[:, j] = nearest_centroids(subvectors, codebook[j])
+    return codes
+
+
+def quantize_matrix(
+        vectors: np.ndarray,
+        vectors_file: str,
+        quantization: str,
+        chunk_size: int = 65536,
+        num_subspaces: Optional[int] = None,
+        sample_size: int = 65536
+):
+    """
+    Quantizes a (memory-mapped) float matrix into `vectors_file`, `chunk_size` rows at a time, and returns the loaded
+    table.
+    :param quantization: One of `METHODS`.
+    :param num_subspaces: pq: number of sub-vectors (bytes per entity). Default: dim / 4.
+    :param sample_size: pq: number of rows to train the codebook on.
+    """
+    if quantization not in METHODS:
+        raise ValueError('Quantization must be one of {}.'.format(', '.join(METHODS)))
+    num_rows, dim = vectors.shape
+    scales_file, codebook_file = side_files(vectors_file)
+    remove_side_files(vectors_file)
+
+    codebook: Optional[np.ndarray] = None
+    if quantization == 'pq':
+        num_subspaces = num_subspaces if num_subspaces is not None else max(dim // 4, 1)
+        # Sorted, so that a memory-mapped matrix is read front to back.
+        sample = np.sort(np.random.RandomState(0).permutation(num_rows)[:sample_size])
+        codebook = train_codebook(unit_rows(vectors[sample]), num_subspaces)
+        codes = np.lib.format.open_memmap(vectors_file, mode='w+', dtype=np.uint8, shape=(num_rows, num_subspaces))
+    else:
+        codes = np.lib.format.open_memmap(vectors_file, mode='w+', dtype=np.dtype(quantization),
+                                          shape=(num_rows, dim))
+    scales = np.zeros(num_rows, dtype=np.float32)
+
+    for start in tqdm(range(0, num_rows, chunk_size), desc='Quantizing'):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        if quantization == 'float16':
+            codes[start:start + len(chunk)] = chunk
+        elif quantization == 'int8':
+            codes[start:start + len(chunk)], scales[start:start + len(chunk)] = int8_codes(chunk)
+        else:
+            codes[start:start + len(chunk)] = pq_codes(unit_rows(chunk), codebook)
+    codes.flush()
+    del codes
+
+    # The side file tells `load_matrix` how to decode the codes. It was removed above and is only saved now that the
+    # codes are complete.
+    if quantization == 'int8':
+        np.save(scales_file, scales)
+    elif quantization == 'pq':
+        np.save(codebook_file, codebook)
+    return load_matrix(vectors_file)
+
+
+def memory_lines(matrix) -> List[str]:
+    """
+    Memory report of a table: its size, and the size and savings compared to a float32 table of the same shape.
+    """
+    num_rows, dim = matrix.shape
+    full_bytes: int = num_rows * dim * np.dtype(np.float32).itemsize
+    size: int = matrix.nbytes
+    return [
+        'Embedding table: {} x {} ({})'.format(num_rows, dim, method(matrix)),
+        'Size: {:.1f} MiB (float32: {:.1f} MiB)'.format(size / 2 ** 20, full_bytes / 2 ** 20),
+        'Saved: {:.1f}% ({:.1f}x smaller)'.format(100 * (1 - size / full_bytes) if full_bytes else 0.0,
+                                                   full_bytes / size if size else 1.0),
+    ]
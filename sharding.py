@@ -0,0 +1,114 @@
+"""
+Sharded, resumable execution of the dataset-processing scripts.
+
+The examples of a data file are split into chunks of `--checkpoint-every` consecutive examples. With `--shard i/N`,
+a run only processes the chunks c with c % N == i and writes to `<save>.shard-i-of-N`, so N runs (e.g., on different
+nodes) together cover the file exactly once; the full output is the concatenation of their outputs
+(grouped by chunk rather than in file order).
+
+The output of every chunk is appended to the output file and committed: the file is flushed to disk, then its size
+and the number of chunks done are written to `<output>.checkpoint` (atomically, via a rename). With `--resume`, the
+output file is truncated back to the last committed size and the run continues with the next chunk, so a crashed
+run neither redoes finished work nor duplicates output. A run without `--resume` starts over with an empty file.
+"""
+
+import os
+from tqdm import tqdm
+from typing import List, Tuple, Optional, Iterable, Callable, Any
+import utils
+from checkpoint import read_checkpoint, write_checkpoint, truncate_uncommitted
+
+
+def add_arguments(parser, checkpoint_every: int = 10000) -> None:
+    parser.add_argument("--shard", help="Process only shard i of N (format: i/N, 0-based). Default: whole file.",
+                        default=None, type=str)
+    parser.add_argument("--checkpoint-every", help="Number of examples per checkpoint. Default: {}.".format(
+        checkpoint_every), default=checkpoint_every, type=int)
+    parser.add_argument("--resume", help="Resume from the last checkpoint of the output file.", action='store_true')
+
+
+def parse_shard(shard: Optional[str]) -> Tuple[int, int]:
+    if shard is None:
+        return 0, 1
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError('Shard must be of the form i/N, got `{}`.'.format(shard))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('Shard index must be in [0, N), got `{}`.'.format(shard))
+    return index, count
+
+
+def shard_output(save: str, shard: Optional[str]) -> str:
+    if shard is None:
+        return save
+    index, count = parse_shard(shard)
+    return '{}.shard-{}-of-{}'.format(save, index, count)
+
+
+def run(
+        read_examples: Callable[[Callable[[int], bool]], Iterable[Any]],
+        process_chunk: Callable[[List[Any]], Iterable[str]],
+        save: str,
+        shard: Optional[str] = None,
+        checkpoint_every: int = 10000,
+        resume: bool = False,
+        compression: Optional[str] = None,
+        total: Optional[int] = None
+) -> str:
+    """
+    Runs `process_chunk` over the chunks of examples of this shard and writes its output lines to the output file,
+    with a checkpoint after every chunk.
+    :param read_examples: Function taking a `select(line_number) -> bool` filter and returning the selected
+                          examples in file order (e.g., `utils.aspect_link_examples` with `select`).
+    :param process_chunk: Function returning the output lines (without newline) of a list of examples.
+    :param save: Output file (the shard suffix is added when `shard` is given).
+    :param shard: Shard to process, `i/N`. Default: all examples.
+    :param checkpoint_every: Number of examples per chunk.
+    :param resume: Continue from the checkpoint of the output file, if there is one.
+    :param compression: Output compression (see `utils.open_output`).
+    :param total: Number of examples in the data file, for the progress bar.
+    :return: The output file.
+    """
+    index, count = parse_shard(shard)
+    output_file: str = shard_output(save, shard)
+    checkpoint = {'shard': [index, count], 'checkpoint_every': checkpoint_every, 'chunks_done': 0, 'size': 0,
+                  'complete': False}
+
+    previous = read_checkpoint(output_file) if resume else None
+    if previous is not None:
+        if previous['shard'] != checkpoint['shard'] or previous['checkpoint_every'] != checkpoint_every:
+            raise ValueError('Checkpoint of {} was written with --shard {}/{} and --checkpoint-every {}.'.format(
+                output_file, previous['shard'][0], previous['shard'][1], previous['checkpoint_every']))
+        checkpoint = previous
+        if checkpoint['complete']:
+            print('Already complete ==> {}'.format(output_file))
+            return output_file
+        print('Resuming after {} chunks.'.format(checkpoint['chunks_done']))
+    # Lines of a chunk that a crashed run appended but never committed are written again below.
+    truncate_uncommitted(output_file, checkpoint)
+
+    first_chunk: int = checkpoint['chunks_done'] * count + index
+
+    def select(line_num: int) -> bool:
+        chunk_num = line_num // checkpoint_every
+        return chunk_num % count == index and chunk_num >= first_chunk
+
+    progress = tqdm(total=max(0, total // count - checkpoint['chunks_done'] * checkpoint_every)
+                    if total is not None else None)
+    for chunk in utils.chunked(read_examples(select), checkpoint_every):
+        lines = process_chunk(chunk)
+        with utils.open_output(output_file, 'a', compression) as f:
+            for line in lines:
+                f.write("%s\n" % line)
+        with open(output_file, 'ab') as f:
+            os.fsync(f.fileno())
+        checkpoint['chunks_done'] += 1
+        checkpoint['size'] = os.path.getsize(output_file)
+        write_checkpoint(output_file, checkpoint)
+        progress.update(len(chunk))
+    progress.close()
+
+    checkpoint['complete'] = True
+    write_checkpoint(output_file, checkpoint)
+    return output_file
@@ -0,0 +1,298 @@
+"""
+Reading and writing TREC run and qrel files, shared by all rankers.
+
+Text formats (whitespace-separated):
+    - run:  query_id Q0 doc_id rank score tag
+    - qrel: query_id Q0 doc_id relevance
+
+A run is read in bulk into a columnar `Run`: the query ids and the interned doc ids are string pools
+(see `description_table.StringPool`), and `offsets` (int64) gives, for every query, a range of rows in `docs` (int32
+doc numbers) and `scores` (float32), in file order. A qrel file is read into the same structure, with the relevance
+labels in `scores`.
+
+A run can also be saved in a binary format: a directory of .npy files (plus `run.json`), memory-mapped on load.
+`read_run` accepts both formats, so large intermediate rankings can be passed between scripts without being
+formatted and parsed again.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional
+from description_table import StringPool
+from checkpoint import written_last
+
+RUN_COLUMNS = 6
+QREL_COLUMNS = 4
+
+
+class Run:
+    def __init__(
+            self,
+            queries: StringPool,
+            doc_pool: StringPool,
+            offsets: np.ndarray,
+            docs: np.ndarray,
+            scores: np.ndarray,
+            tag: str = ''
+    ):
+        self.queries = queries
+        self.doc_pool = doc_pool
+        self.offsets = offsets
+        self.docs = docs
+        self.scores = scores
+        self.tag = tag
+        self.query_index: Dict[str, int] = {query_id: i for i, query_id in enumerate(queries)}
+
+    @classmethod
+    def from_columns(
+            cls,
+            query_ids: List[str],
+            doc_ids: List[str],
+            scores: np.ndarray,
+            k: Optional[int] = None,
+            tag: str = ''
+    ) -> 'Run':
+        """
+        Builds a run from one (query_id, doc_id, score) row per entry, in file order.
+        Rows are grouped by query (queries in order of first appearance, entries in file order).
+        :param k: Keep only the first k entries of every query.
+        """
+        query_nums: Dict[str, int] = {q: i for i, q in enumerate(dict.fromkeys(query_ids))}
+        doc_nums: Dict[str, int] = {d: i for i, d in enumerate(dict.fromkeys(doc_ids))}
+        row_queries = np.fromiter(map(query_nums.__getitem__, query_ids), dtype=np.int64, count=len(query_ids))
+        row_docs = np.fromiter(map(doc_nums.__getitem__, doc_ids), dtype=np.int32, count=len(doc_ids))
+        scores = np.asarray(scores, dtype=np.float32)
+
+        order = np.argsort(row_queries, kind='stable')
+        counts = np.bincount(row_queries, minlength=len(query_nums))
+        offsets = np.zeros(len(query_nums) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if k is not None:
+            # Position of every (grouped) row within its query.
+            positions = np.arange(len(order)) - np.repeat(offsets[:-1], counts)
+            order = order[positions < k]
+            np.cumsum(np.minimum(counts, k), out=offsets[1:])
+
+        return cls(
+            queries=StringPool.from_strings(list(query_nums.keys())),
+            doc_pool=StringPool.from_strings(list(doc_nums.keys())),
+            offsets=offsets,
+            docs=row_docs[order],
+            scores=scores[order],
+            tag=tag
+        )
+
+    @staticmethod
+    def is_binary(path: str) -> bool:
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, 'run.json'))
+
+    @classmethod
+    def load(cls, run_dir: str, mmap: bool = True) -> 'Run':
+        with open(os.path.join(run_dir, 'run.json'), 'r') as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        return cls(
+            queries=StringPool.load(os.path.join(run_dir, 'queries'), mmap),
+            doc_pool=StringPool.load(os.path.join(run_dir, 'doc_ids'), mmap),
+            offsets=np.load(os.path.join(run_dir, 'offsets.npy'), mmap_mode=mmap_mode),
+            docs=np.load(os.path.join(run_dir, 'docs.npy'), mmap_mode=mmap_mode),
+            scores=np.load(os.path.join(run_dir, 'scores.npy'), mmap_mode=mmap_mode),
+            tag=meta['tag']
+        )
+
+    def save(self, run_dir: str) -> None:
+        os.makedirs(run_dir, exist_ok=True)
+        meta = {'tag': self.tag, 'num_queries': len(self.queries), 'num_entries': len(self.docs)}
+        # `read_run` takes a directory with a run.json for a binary run (see `is_binary`).
+        with written_last(os.path.join(run_dir, 'run.json'), meta):
+            self.queries.save(os.path.join(run_dir, 'queries'))
+            self.doc_pool.save(os.path.join(run_dir, 'doc_ids'))
+            np.save(os.path.join(run_dir, 'offsets.npy'), self.offsets)
+            np.save(os.path.join(run_dir, 'docs.npy'), self.docs)
+            np.save(os.path.join(run_dir, 'scores.npy'), self.scores)
+
+    def __len__(self) -> int:
+        return len(self.queries)
+
+    def __contains__(self, query_id: str) -> bool:
+        return query_id in self.query_index
+
+    def rows(self, query_id: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Doc numbers and scores of a query, in file order.
+        """
+        i = self.query_index[query_id]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.docs[start:end], self.scores[start:end]
+
+    def __getitem__(self, query_id: str) -> Dict[str, float]:
+        docs, scores = self.rows(query_id)
+        return {self.doc_pool[d]: s for d, s in zip(docs.tolist(), scores.tolist())}
+
+    def get(self, query_id: str, default=None):
+        return self[query_id] if query_id in self else default
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, float]]]:
+        for query_id in self.queries:
+            yield query_id, self[query_id]
+
+    def lines(self) -> Iterator[str]:
+        """
+        The run in text format, ranked in file order.
+        Scores are written as float32 values, i.e., with the digits that float32 keeps.
+        """
+        for query_id in self.queries:
+            docs, scores = self.rows(query_id)
+            ranked = zip((self.doc_pool[d] for d in docs.tolist()), scores)
+            yield from run_lines(query_id, ranked, self.tag)
+
+
+def read_columns(
+        path: str,
+        num_columns: int,
+        value_column: int,
+        block_size: int = 1 << 24
+) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Reads the query id, doc id and value (score or relevance) columns of a whitespace-separated file,
+    `block_size` bytes at a time. Blank lines are skipped.
+    Every block is split in one call, and the columns are taken with strided slices.
+    """
+    query_ids: List[str] = []
+    doc_ids: List[str] = []
+    values: List[str] = []
+    with open(path, 'r') as f:
+        while True:
+            lines: List[str] = f.readlines(block_size)
+            if not lines:
+                break
+            tokens: List[str] = ''.join(lines).split()
+            num_lines: int = sum(1 for line in lines if not line.isspace())
+            if len(tokens) != num_columns * num_lines:
+                raise ValueError('{}: every line must have {} columns.'.format(path, num_columns))
+            query_ids.extend(tokens[0::num_columns])
+            doc_ids.extend(tokens[2::num_columns])
+            values.extend(tokens[value_column::num_columns])
+    return query_ids, doc_ids, values
+
+
+def read_run(path: str, k: Optional[int] = None) -> Run:
+    """
+    Reads a run file (text or binary).
+    :param k: Keep only the first k entries of every query (in file order, i.e., by rank).
+    """
+    if Run.is_binary(path):
+        run = Run.load(path)
+        return run if k is None else Run.from_columns(*_columns(run), k=k, tag=run.tag)
+    query_ids, doc_ids, scores = read_columns(path, RUN_COLUMNS, value_column=4)
+    with open(path, 'r') as f:
+        first_line = next((line.split() for line in f if not line.isspace()), [])
+    return Run.from_columns(query_ids, doc_ids, np.asarray(scores, dtype=np.float32), k=k,
+                            tag=first_line[5] if first_line else '')
+
+
+def read_qrels(path: str) -> Run:
+    """
+    Reads a qrel file. The relevance labels are stored as the scores of the returned `Run`.
+    """
+    query_ids, doc_ids, labels = read_columns(path, QREL_COLUMNS, value_column=3)
+    return Run.from_columns(query_ids, doc_ids, np.asarray(labels, dtype=np.float32))
+
+
+def _columns(run: Run) -> Tuple[List[str], List[str], np.ndarray]:
+    counts = np.diff(run.offsets)
+    query_ids: List[str] = [query_id for query_id, count in zip(run.queries, counts.tolist()) for _ in range(count)]
+    doc_ids: List[str] = [run.doc_pool[d] for d in np.asarray(run.docs).tolist()]
+    return query_ids, doc_ids, np.asarray(run.scores)
+
+
+def read_run_groups(lines: Iterable[str], k: Optional[int] = None) -> Iterator[Tuple[str, Dict[str, float]]]:
+    """
+    Streams the {doc_id: score} dict of every query of a run whose queries are contiguous and in ascending order
+    (e.g., sorted with `utils.external_sort`). With `k`, only the first k entries of every query are kept.
+    Blank lines are skipped.
+    """
+    query_id, scores = None, {}
+    for line in lines:
+        line_parts = line.split()
+        if not line_parts:
+            continue
+        if line_parts[0] != query_id:
+            if query_id is not None:
+                if line_parts[0] < query_id:
+                    raise ValueError('Run is not sorted by query id.')
+                yield query_id, scores
+            query_id, scores = line_parts[0], {}
+        if k is None or len(scores) < k:
+            scores[line_parts[2]] = float(line_parts[4])
+    if query_id is not None:
+        yield query_id, scores
+
+
+def run_lines(
+        query_id: str,
+        ranked: Iterable[Tuple[str, float]],
+        tag: str,
+        skip_zero: bool = False
+) -> Iterator[str]:
+    """
+    Run file lines of one query. `ranked` is the (doc_id, score) pairs of the query, best first.
+    :param skip_zero: Skip entries with a score of 0 (they keep their rank, so the ranks of later entries do not
+                      change).
+    """
+    prefix: str = query_id + ' Q0 '
+    suffix: str = ' ' + tag
+    for rank, (doc_id, score) in enumerate(ranked, start=1):
+        if not skip_zero or score != 0:
+            yield prefix + doc_id + ' ' + str(rank) + ' ' + str(score) + suffix
+
+
+def qrel_line(query_id: str, doc_id: str, relevance: int = 1) -> str:
+    return query_id + ' Q0 ' + doc_id + ' ' + str(relevance)
+
+
+def write_lines(lines: Iterable[str], output_file: str, mode: str = 'w', batch_size: int = 65536) -> None:
+    """
+    Writes lines (without newline) in batches of `batch_size`, each joined into one string and written at once.
+    """
+    batch: List[str] = []
+    with open(output_file, mode, buffering=1 << 20) as f:
+        for line in lines:
+            batch.append(line)
+            if len(batch) == batch_size:
+                f.write('\n'.join(batch) + '\n')
+                batch = []
+        if batch:
+            f.write('\n'.join(batch) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser("Convert a run file between the text and the binary format.")
+    parser.add_argument("--run", help="Run file (text or binary).", required=True, type=str)
+    parser.add_argument("--save", help="Output run file (a directory for the binary format).", required=True,
+                        type=str)
+    parser.add_argument("--format", help="Output format (text|binary). Default: binary.", default='binary',
+                        choices=['text', 'binary'])
+    parser.add_argument("--k", help="Keep only the top-K entries of every query. Default: all.", default=None,
+                        type=int)
+    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+
+    print('Reading run file...')
+    run: Run = read_run(args.run, args.k)
+    print('[Done].')
+    print('Queries = {}, entries = {}'.format(len(run), len(run.docs)))
+
+    print('Writing to file...')
+    if args.format == 'binary':
+        run.save(args.save)
+    else:
+        write_lines(run.lines(), args.save)
+    print('[Done].')
+    print('Run written to ==> {}'.format(args.save))
+
+
+if __name__ == '__main__':
+    main()
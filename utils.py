@@ -8,14 +8,136 @@ from tqdm import tqdm
 import joblib
 import contextlib
 import json
+import shutil
+import subprocess
+import multiprocessing
+import os
+import hashlib
+import heapq
+import tempfile
+import operator
+from collections import deque, OrderedDict
 from pykson import Pykson, JsonObject, StringField, IntegerField, ListField, ObjectListField, ObjectField, Pykson, \
     BooleanField
 from object_models import Location, Entity, AnnotatedText, AspectLinkExample, Aspect, Context
+from object_models import LocationRecord, EntityRecord, AnnotatedTextRecord, ContextRecord, AspectRecord, \
+    AspectLinkRecord
+import dataset_cache
+from description_table import DescriptionTable, load_table
 import torch
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Fields that can be requested from `aspect_link_examples`:
+#   id, unhashed_id, true_aspect: the corresponding example attributes.
+#   target_entity: context.target_entity.
+#   sentence, paragraph: context.sentence / context.paragraph (content and entities).
+#   aspects: candidate_aspects with aspect_id, aspect_name and the entities of aspect_content.
+#   aspect_text: aspect_content.content of every candidate aspect (requires `aspects`).
+#   location: context.location and the location of every candidate aspect.
+#   mentions: all entity attributes, not only entity_id.
+EXAMPLE_FIELDS = frozenset(['id', 'unhashed_id', 'true_aspect', 'target_entity', 'sentence', 'paragraph', 'aspects',
+                            'aspect_text', 'location', 'mentions'])
+
+
+_NON_ALPHABETIC = re.compile(r"[^a-zA-Z\']")
+_NON_ASCII = re.compile(r"[^\x00-\x7F]+")
+_PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+# LMDB environments opened by this process, by path. LMDB allows only one environment per database and process.
+_lmdb_environments: Dict[str, Any] = {}
+_lmdb_pid = None
+
+
+def open_lmdb(path: str, map_size: int):
+    # An LMDB environment must not be used across fork(), so each process opens its own.
+    global _lmdb_pid
+    if _lmdb_pid != os.getpid():
+        _lmdb_environments.clear()
+        _lmdb_pid = os.getpid()
+    if path not in _lmdb_environments:
+        import lmdb
+        # Commits are not fsynced one by one: `PreprocessingCache.put_many` syncs once per batch. Syncing at exit
+        # would not do, as pool workers leave with os._exit and skip exit handlers.
+        _lmdb_environments[path] = lmdb.open(path, map_size=map_size, subdir=True, lock=True, sync=False)
+    return _lmdb_environments[path]
+
+
+class PreprocessingCache:
+    """
+    Cache of preprocessed texts, keyed by a hash of the raw text.
+    An in-process LRU holds up to `max_size` entries. If `path` is given, entries are also stored in an LMDB
+    database at `path`, which is shared by all worker processes and persists across runs.
+    """
+
+    def __init__(self, path: str = None, max_size: int = 100000, map_size: int = 1 << 36):
+        self.path = path
+        self.max_size = max_size
+        self.map_size = map_size
+        self.hits = 0
+        self.misses = 0
+        self._lru: OrderedDict = OrderedDict()
+
+    def _db(self):
+        return open_lmdb(self.path, self.map_size) if self.path is not None else None
+
+    @staticmethod
+    def key(text: str, salt: str = '') -> bytes:
+        return hashlib.blake2b((salt + '\0' + text).encode('UTF-8'), digest_size=16).digest()
+
+    def get(self, key: bytes):
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return self._lru[key]
+        db = self._db()
+        if db is not None:
+            with db.begin() as txn:
+                value = txn.get(key)
+            if value is not None:
+                self.hits += 1
+                value = value.decode('UTF-8')
+                self._remember(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key: bytes, value: str) -> None:
+        self.put_many([(key, value)])
+
+    def put_many(self, items: List[Tuple[bytes, str]]) -> None:
+        """
+        Stores many entries with a single LMDB write transaction, synced to disk once: the write lock is shared by
+        all workers, so one transaction per text would serialize them.
+        """
+        for key, value in items:
+            self._remember(key, value)
+        db = self._db()
+        if db is not None and items:
+            with db.begin(write=True) as txn:
+                for key, value in items:
+                    txn.put(key, value.encode('UTF-8'))
+            db.sync(True)
+
+    def _remember(self, key: bytes, value: str) -> None:
+        self._lru[key] = value
+        if len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
 
 class TextProcessor:
-    def __init__(self, model='en_core_web_sm'):
+    def __init__(self, model='en_core_web_sm', cache: PreprocessingCache = None):
+        """
+        :param model: spaCy model.
+        :param cache: Cache of preprocessed texts. Default: an in-process LRU cache.
+        """
+        self._model_name = model
+        self.cache = cache if cache is not None else PreprocessingCache()
+        self._prepared: Dict[str, str] = {}
         try:
             self._model = spacy.load(model, disable=["ner", "parser"])
         except OSError:
@@ -35,37 +157,91 @@ class TextProcessor:
         return spacy.load(model, disable=["ner", "parser"])
 
     def preprocess(self, text: str) -> str:
+        if text in self._prepared:
+            return self._prepared[text]
+        key = PreprocessingCache.key(text, self._model_name) if self.cache is not None else None
+        if key is not None:
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+        value = self._postprocess(self._model(self._clean(text)))
+        if key is not None:
+            self.cache.put(key, value)
+        return value
+
+    @contextlib.contextmanager
+    def prepared(self, texts: List[str], batch_size: int = 256, n_process: int = 1):
+        """
+        Preprocesses `texts` with one `preprocess_batch` call, and serves them from memory to the
+        `preprocess`/`preprocess_batch` calls made inside the `with` block.
+        """
+        self._prepared = dict(zip(texts, self.preprocess_batch(texts, batch_size, n_process)))
+        try:
+            yield self
+        finally:
+            self._prepared = {}
+
+    def preprocess_batch(self, texts: List[str], batch_size: int = 256, n_process: int = 1) -> List[str]:
+        """
+        Preprocess many texts with one `nlp.pipe` call.
+        Texts found in the cache and repeated texts are preprocessed only once.
+        :param texts: Texts to preprocess.
+        :param batch_size: Number of texts spaCy processes at a time.
+        :param n_process: Number of processes spaCy uses.
+        :return: Preprocessed texts, in input order.
+        """
+        res: Dict[str, str] = {}
+        keys: Dict[str, bytes] = {}
+        for text in texts:
+            if text in res or text in keys:
+                continue
+            if text in self._prepared:
+                res[text] = self._prepared[text]
+                continue
+            if self.cache is not None:
+                key = PreprocessingCache.key(text, self._model_name)
+                value = self.cache.get(key)
+                if value is not None:
+                    res[text] = value
+                    continue
+                keys[text] = key
+            else:
+                keys[text] = None
+
+        todo: List[str] = list(keys.keys())
+        if todo:
+            docs = self._model.pipe((self._clean(text) for text in todo), batch_size=batch_size, n_process=n_process)
+            for text, doc in zip(todo, docs):
+                res[text] = self._postprocess(doc)
+            if self.cache is not None:
+                self.cache.put_many([(keys[text], res[text]) for text in todo])
+
+        return [res[text] for text in texts]
 
+    @staticmethod
+    def _clean(text: str) -> str:
         # Remove Unicode characters otherwise spacy complains
-        text = text.encode("ascii", "ignore")
-        text = text.decode()
-        doc = self._model(text)
-
-        # 1. Tokenize
-        tokens = [token for token in doc]
+        return text.encode("ascii", "ignore").decode()
 
-        # 2. Remove numbers
-        tokens = [token for token in tokens if not (token.like_num or token.is_currency)]
-
-        # 3. Remove stopwords
-        tokens = [token for token in tokens if not token.is_stop]
-
-        # 4. Remove special tokens
-        tokens = [token for token in tokens if
-                  not (token.is_punct or token.is_space or token.is_quote or token.is_bracket)]
-        tokens = [token for token in tokens if token.text.strip() != ""]
+    @staticmethod
+    def _postprocess(doc: Doc) -> str:
 
+        # 1. Tokenize, 2. Remove numbers, 3. Remove stopwords, 4. Remove special tokens (in one pass)
         # 5. Lemmatization
-        text = " ".join([token.lemma_ for token in tokens])
+        text = " ".join([
+            token.lemma_ for token in doc
+            if not (token.like_num or token.is_currency or token.is_stop or token.is_punct or token.is_space or
+                    token.is_quote or token.is_bracket) and token.text.strip() != ""
+        ])
 
         # 6. Remove non-alphabetic characters
-        text = re.sub(r"[^a-zA-Z\']", " ", text)
+        text = _NON_ALPHABETIC.sub(" ", text)
 
         # 7. Remove non-Unicode characters
-        text = re.sub(r"[^\x00-\x7F]+", "", text)
+        text = _NON_ASCII.sub("", text)
 
         # . 8. Remove punctuation
-        text = text.translate(str.maketrans('', '', string.punctuation))
+        text = text.translate(_PUNCTUATION_TABLE)
 
         # 9. Lowercase
         text = text.lower()
@@ -73,16 +249,308 @@ class TextProcessor:
         return text
 
 
-def aspect_link_examples(json_file: str) -> AspectLinkExample:
+def aspect_link_examples(json_file: str, fields=None, fast: bool = True, num_workers: int = 1, select=None):
     """
     Reads the JSON-L file in gzip format.
     Generates an AspectLinkExample in a lazy way (using yield).
+    By default, examples are parsed with plain JSON into lightweight records (see `object_models.AspectLinkRecord`)
+    which expose the same attributes as the Pykson models. If an up-to-date cache of the file exists
+    (see `dataset_cache.py`) and it holds all requested fields, examples are read from the cache instead.
     :param json_file: JSON-L file in gzip format.
+    :param fields: Fields to load (see `EXAMPLE_FIELDS`). Default: all fields. Attributes of fields that are not
+                   loaded are None (or empty lists).
+    :param fast: If False, examples are parsed into Pykson models (AspectLinkExample) and `fields` is ignored.
+    :param num_workers: Number of parser processes. If > 1, see `parallel_aspect_link_examples`.
+    :param select: Optional function of the (0-based) line number. Lines for which it returns False are skipped
+                   without being parsed.
     """
+    fields = EXAMPLE_FIELDS if fields is None else frozenset(fields)
+    unknown = fields - EXAMPLE_FIELDS
+    if unknown:
+        raise ValueError('Unknown fields: {}'.format(', '.join(sorted(unknown))))
+
+    if fast and fields <= dataset_cache.CACHED_FIELDS and dataset_cache.has_valid_cache(json_file):
+        cache = dataset_cache.DatasetCache(dataset_cache.cache_dir_for(json_file))
+        for i in range(len(cache)):
+            if select is None or select(i):
+                yield cache[i]
+        return
+    if fast and num_workers > 1:
+        yield from parallel_aspect_link_examples(json_file, fields, num_workers, select=select)
+        return
     with gzip.open(json_file, 'rt', encoding='UTF-8') as zipfile:
-        for line in zipfile:
-            example = Pykson().from_json(line, AspectLinkExample)
-            yield example
+        for line_num, line in enumerate(zipfile):
+            if select is not None and not select(line_num):
+                continue
+            if fast:
+                yield to_aspect_link_record(_json_loads(line), fields)
+            else:
+                yield Pykson().from_json(line, AspectLinkExample)
+
+
+def decompressed_lines(json_file: str):
+    """
+    Lines of a gzip file, decompressed in a separate process (`pigz`, or `gzip` if pigz is not installed)
+    so that decompression runs concurrently with the consumer. Falls back to the gzip module if neither exists.
+    Raises `subprocess.CalledProcessError` after the last line if the decompressor failed (e.g., on a corrupt file),
+    as the gzip module would.
+    """
+    decompressor = shutil.which('pigz') or shutil.which('gzip')
+    if decompressor is None:
+        with gzip.open(json_file, 'rt', encoding='UTF-8') as zipfile:
+            yield from zipfile
+        return
+
+    process = subprocess.Popen([decompressor, '-dc', json_file], stdout=subprocess.PIPE, bufsize=1 << 20)
+    exhausted = False
+    try:
+        for line in process.stdout:
+            yield line.decode('UTF-8')
+        exhausted = True
+    finally:
+        process.stdout.close()
+        # Only a reader that stops early (the generator is closed) leaves the decompressor running.
+        if not exhausted:
+            process.kill()
+        process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def _parse_chunk(lines: List[str], fields) -> List[AspectLinkRecord]:
+    return [to_aspect_link_record(_json_loads(line), fields) for line in lines]
+
+
+def parallel_aspect_link_examples(
+        json_file: str,
+        fields=EXAMPLE_FIELDS,
+        num_workers: int = 4,
+        chunk_size: int = 256,
+        select=None
+):
+    """
+    Pipelined version of `aspect_link_examples`.
+    One stage decompresses the file (see `decompressed_lines`), `num_workers` processes parse chunks of
+    `chunk_size` lines and the results are yielded in file order (see `ordered_imap`).
+    """
+    lines = decompressed_lines(json_file)
+    if select is not None:
+        lines = (line for line_num, line in enumerate(lines) if select(line_num))
+    with multiprocessing.Pool(num_workers) as pool:
+        chunks = ((chunk, fields) for chunk in chunked(lines, chunk_size))
+        for records in ordered_imap(pool, _parse_chunk, chunks, max_pending=2 * num_workers):
+            yield from records
+
+
+def external_sort(lines, key, chunk_size: int = 1000000, tmp_dir: str = None):
+    """
+    Sorts lines by `key` with at most `chunk_size` lines in memory. Every line is yielded ending with a newline
+    (the last line of a file may have none, and would otherwise run into the next line of its sorted run).
+    Sorted runs of `chunk_size` lines are written to temporary files and merged with `heapq.merge`.
+    The sort is stable: lines with the same key keep their input order.
+    :param key: Function returning the sort key (a string without tabs or newlines) of a line.
+                It is called once per line; the key is stored in front of the line in the temporary files.
+    :param tmp_dir: Directory for the temporary files. Default: the system temporary directory.
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        run_files: List[str] = []
+        keyed_lines = ("%s\t%s" % (key(line), line if line.endswith('\n') else line + '\n') for line in lines)
+        for chunk in chunked(keyed_lines, chunk_size):
+            chunk.sort(key=_sort_key)
+            run_files.append(os.path.join(tmp, 'run-%d' % len(run_files)))
+            with open(run_files[-1], 'w', encoding='UTF-8') as f:
+                f.writelines(chunk)
+        runs = [open(run_file, 'r', encoding='UTF-8') for run_file in run_files]
+        try:
+            for keyed_line in heapq.merge(*runs, key=_sort_key):
+                yield keyed_line.split('\t', 1)[1]
+        finally:
+            for run in runs:
+                run.close()
+
+
+def _sort_key(keyed_line: str) -> str:
+    return keyed_line.split('\t', 1)[0]
+
+
+def sorted_aspect_link_examples(json_file: str, fields=None, select=None, chunk_size: int = 100000,
+                                tmp_dir: str = None):
+    """
+    Examples of a data file in ascending order of query id (see `external_sort`), e.g., for a merge-join with a
+    run file sorted by query id.
+    :param select: Optional function of the (0-based) position in sorted order. Examples for which it returns False
+                   are skipped without being parsed.
+    """
+    fields = EXAMPLE_FIELDS if fields is None else frozenset(fields)
+    lines = external_sort(decompressed_lines(json_file), key=lambda line: _json_loads(line)['id'],
+                          chunk_size=chunk_size, tmp_dir=tmp_dir)
+    for line_num, line in enumerate(lines):
+        if select is None or select(line_num):
+            yield to_aspect_link_record(_json_loads(line), fields)
+
+
+def chunked(iterable, chunk_size: int):
+    """
+    Splits an iterable into lists of `chunk_size` items (the last one may be shorter).
+    """
+    chunk: List[Any] = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _call_chunk(func, chunk: List[Tuple]) -> List[Any]:
+    return [func(*args) for args in chunk]
+
+
+def ordered_imap(pool, func, args_iterable, max_pending: int, chunk_size: int = 1, call_chunk=_call_chunk):
+    """
+    Like `pool.imap(func, ...)`, but with bounded memory.
+    `pool.imap` reads its whole input ahead of the workers; here at most `max_pending` chunks are in flight,
+    so neither the input nor the results pile up in memory.
+    Results are yielded in input order.
+    :param pool: A multiprocessing.Pool.
+    :param func: Function to apply. Must be picklable (i.e., defined at module level).
+    :param args_iterable: Iterable of argument tuples for `func`.
+    :param max_pending: Maximum number of chunks submitted but not yet yielded. About twice the number of
+    processes of the pool keeps every worker busy.
+    :param chunk_size: Number of calls sent to a worker at once.
+    :param call_chunk: Function the workers run on `(func, chunk)`, returning the results of the chunk.
+    """
+    pending = deque()
+    for chunk in chunked(args_iterable, chunk_size):
+        pending.append(pool.apply_async(call_chunk, (func, chunk)))
+        if len(pending) >= max_pending:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+
+def open_output(output_file: str, mode: str = 'w', compression: str = None):
+    """
+    Opens a text file for writing, optionally compressed (gzip|zstd).
+    zstd requires the `zstandard` package.
+    """
+    if compression is None or compression == 'none':
+        return open(output_file, mode, buffering=1 << 20)
+    if compression == 'gzip':
+        return gzip.open(output_file, mode + 't', encoding='UTF-8')
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.open(output_file, mode + 't', encoding='UTF-8')
+    raise ValueError('Compression must be `gzip` or `zstd`.')
+
+
+def to_location_record(location) -> LocationRecord:
+    if location is None:
+        return None
+    return LocationRecord(
+        location_id=location.get('location_id'),
+        page_id=location.get('page_id'),
+        page_title=location.get('page_title'),
+        paragraph_id=location.get('paragraph_id'),
+        section_id=location.get('section_id'),
+        section_headings=location.get('section_headings')
+    )
+
+
+def to_annotated_text_record(annotated_text, with_content: bool, with_mentions: bool) -> AnnotatedTextRecord:
+    if annotated_text is None:
+        return None
+    if with_mentions:
+        entities = [
+            EntityRecord(
+                entity_id=entity.get('entity_id'),
+                entity_name=entity.get('entity_name'),
+                mention=entity.get('mention'),
+                target_mention=entity.get('target_mention'),
+                start=entity.get('start'),
+                end=entity.get('end')
+            )
+            for entity in annotated_text.get('entities') or []
+        ]
+    else:
+        entities = [EntityRecord(entity_id=entity.get('entity_id')) for entity in annotated_text.get('entities') or []]
+    return AnnotatedTextRecord(content=annotated_text.get('content') if with_content else None, entities=entities)
+
+
+def to_aspect_link_record(example, fields=EXAMPLE_FIELDS) -> AspectLinkRecord:
+    """
+    Builds an AspectLinkRecord holding the requested `fields` of a parsed JSON example.
+    """
+    with_location = 'location' in fields
+    with_mentions = 'mentions' in fields
+
+    context = example.get('context')
+    context_record = None
+    if context is not None and (fields & {'target_entity', 'sentence', 'paragraph', 'location'}):
+        context_record = ContextRecord(
+            target_entity=context.get('target_entity') if 'target_entity' in fields else None,
+            location=to_location_record(context.get('location')) if with_location else None,
+            sentence=to_annotated_text_record(context.get('sentence'), True, with_mentions)
+            if 'sentence' in fields else None,
+            paragraph=to_annotated_text_record(context.get('paragraph'), True, with_mentions)
+            if 'paragraph' in fields else None
+        )
+
+    candidate_aspects = None
+    if 'aspects' in fields:
+        with_text = 'aspect_text' in fields
+        candidate_aspects = [
+            AspectRecord(
+                aspect_id=aspect.get('aspect_id'),
+                aspect_name=aspect.get('aspect_name'),
+                location=to_location_record(aspect.get('location')) if with_location else None,
+                aspect_content=to_annotated_text_record(aspect.get('aspect_content'), with_text, with_mentions)
+            )
+            for aspect in example.get('candidate_aspects') or []
+        ]
+
+    return AspectLinkRecord(
+        id=example.get('id') if 'id' in fields else None,
+        unhashed_id=example.get('unhashed_id') if 'unhashed_id' in fields else None,
+        context=context_record,
+        true_aspect=example.get('true_aspect') if 'true_aspect' in fields else None,
+        candidate_aspects=candidate_aspects
+    )
+
+
+def texts_to_preprocess(
+        query: str,
+        docs: Dict[str, str],
+        doc_ids: List[str],
+        docs_preprocessed: bool = False
+) -> List[str]:
+    """
+    The texts `preprocess_query_and_docs` preprocesses for the same arguments.
+    """
+    if docs_preprocessed:
+        return [query]
+    return [query] + [docs[doc_id] for doc_id in dict.fromkeys(doc_ids) if doc_id in docs]
+
+
+def preprocess_query_and_docs(
+        processor: TextProcessor,
+        query: str,
+        docs: Dict[str, str],
+        doc_ids: List[str],
+        docs_preprocessed: bool = False
+) -> Tuple[str, Dict[str, str]]:
+    """
+    Preprocess a query and the documents `docs[doc_id]` of the given ids (ids not in `docs` are skipped)
+    with one call to `processor.preprocess_batch`.
+    :param docs_preprocessed: If True, the documents are already preprocessed and only the query is.
+    :return: The preprocessed query and a dict of preprocessed documents.
+    """
+    doc_ids = [doc_id for doc_id in dict.fromkeys(doc_ids) if doc_id in docs]
+    if docs_preprocessed:
+        return processor.preprocess(query), {doc_id: docs[doc_id] for doc_id in doc_ids}
+    texts: List[str] = processor.preprocess_batch(texts_to_preprocess(query, docs, doc_ids))
+    return texts[0], dict(zip(doc_ids, texts[1:]))
 
 
 def get_entity_ids_only(entities) -> List[str]:
@@ -100,6 +568,16 @@ def get_entities(candidate_aspects: List[Aspect], true_aspect: str) -> Tuple[Set
     return pos_entities, set(neg_entities)
 
 
+def top_k_items(scores: Dict[str, float], k: int = None) -> List[Tuple[str, float]]:
+    """
+    The k highest-scoring (id, score) pairs, best first; ties keep their order in `scores`.
+    Same result as sorted(scores.items(), key=score, reverse=True)[:k], but in O(n log k) with a heap.
+    """
+    if k is None or k >= len(scores):
+        return sorted(scores.items(), key=operator.itemgetter(1), reverse=True)
+    return heapq.nlargest(k, scores.items(), key=operator.itemgetter(1))
+
+
 def write_to_file(data: List[str], output_file: str):
     with open(output_file, 'a') as f:
         for line in data:
@@ -122,6 +600,60 @@ def read_entity_data_file(file_path: str) -> Dict[str, Dict[str, str]]:
     return res
 
 
+def load_entity_data(path: str) -> Tuple[DescriptionTable, bool]:
+    """
+    Reads entity descriptions into a compact description table (see `description_table.py`).
+    :param path: A raw description file, a preprocessed description store or a saved description table.
+    :return: The descriptions and whether they are already preprocessed.
+    """
+    table: DescriptionTable = load_table(path)
+    return table, table.preprocessed
+
+
+_worker_processor: TextProcessor = None
+
+
+def worker_processor() -> TextProcessor:
+    """
+    The TextProcessor of the data builders, created on first use. Created in the main process at import time,
+    it is inherited by the pool workers through fork instead of loading spaCy again in every worker.
+    """
+    global _worker_processor
+    if _worker_processor is None:
+        _worker_processor = TextProcessor()
+    return _worker_processor
+
+
+def init_worker(preprocess_cache: str = None) -> None:
+    """
+    Pool initializer of the data builders: runs once in every worker process and opens the persistent
+    preprocessing cache there (an LMDB environment must not be shared across fork).
+    """
+    if preprocess_cache is not None:
+        worker_processor().cache = PreprocessingCache(path=preprocess_cache)
+
+
+def preprocess_chunk(func, chunk: List[Tuple], texts, n_process: int = 1) -> List[Any]:
+    """
+    Chunk function of `ordered_imap` for the data builders: preprocesses the texts of every example in the chunk
+    with one batched spaCy call, then runs `func` on every example (its preprocessing is then served from memory).
+    :param texts: Function returning the texts `func` preprocesses for the same arguments.
+    :param n_process: Number of processes spaCy uses.
+    """
+    with worker_processor().prepared([text for args in chunk for text in texts(*args)], n_process=n_process):
+        return [func(*args) for args in chunk]
+
+
+def worker_payloads(examples, context_type: str, desc_dict: DescriptionTable, desc_preprocessed: bool):
+    """
+    Arguments sent to the workers for every example: the example and the descriptions of its query only.
+    Examples without descriptions produce no data and are not sent at all.
+    """
+    for example in examples:
+        if example.id in desc_dict:
+            yield example, context_type, {example.id: desc_dict[example.id]}, desc_preprocessed
+
+
 @contextlib.contextmanager
 def tqdm_joblib(tqdm_object):
     """